@@ -1,51 +1,168 @@
 import pandas as pd
+import numpy as np
 import streamlit as st
 import re
-from collections import Counter
+import io
+import os
+import sys
+import shutil
+import atexit
+import hashlib
+import tempfile
+import zipfile
+import heapq
+import itertools
+import zlib
+import json
+import time
+import queue
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from scipy import sparse
 from textblob import TextBlob
 import nltk
 from nltk.tokenize import sent_tokenize
 import plotly.express as px  # 用于画NSS图表
+from matplotlib import colormaps
 
-# 自动处理分句器所需的数据包
+# 自动处理分句器所需的数据包；设置 NLTK_AUTO_DOWNLOAD=0 可跳过下载（离线部署时改用正则分句器）
 def load_nltk_resources():
     resources = ['punkt', 'punkt_tab'] # 兼容新旧版本的资源包
-    for res in resources:
-        try:
-            nltk.data.find(f'tokenizers/{res}')
-        except LookupError:
-            nltk.download(res)
-
-load_nltk_resources()
+    if os.environ.get("NLTK_AUTO_DOWNLOAD", "1") != "0":
+        for res in resources:
+            try:
+                nltk.data.find(f'tokenizers/{res}')
+            except LookupError:
+                nltk.download(res, quiet=True)
+    try:
+        sent_tokenize("ok. ok.")
+    except LookupError:
+        return False
+    return True
+
+PUNKT_AVAILABLE = load_nltk_resources()
+
+# --- 分句后端 ---
+# punkt：NLTK 原版分句，口径基准；regex：编译好的正则一次切分整列评论，不依赖 NLTK 数据包。
+# 正则规则：句末标点（含省略号、连续的 !?）后接空白即断句，跳过常见缩写和单字母缩写；
+# 评论里常见的“表情代替句号”（😍 后接空白）也视为断句。与 punkt 的差异可在一致性校验板块查看。
+SENTENCE_ABBREVIATIONS = ["mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g", "i.e",
+                          "inc", "ltd", "co", "approx", "oz", "lbs", "u.s", "misc"]
+EMOJI_CHARS = "\U0001F300-\U0001FAFF\u2600-\u27BF\uFE0F"
+
+def build_sentence_boundary(abbreviations):
+    # 先用正向后顾确认前一个字符是句末标点，再排除缩写；lookbehind 需定长，缩写按长度分组
+    by_length = {}
+    for a in abbreviations:
+        by_length.setdefault(len(a), []).append(re.escape(a))
+    guards = "".join(rf"(?<!\b(?:{'|'.join(group)})\.)" for group in by_length.values())
+    return re.compile(
+        rf"(?<=[.!?…\"')\]{EMOJI_CHARS}])"                   # 快速预筛：绝大多数位置在这里就失败
+        + r"(?:(?<=[.!?…])" + guards + r"(?<!\b[a-hj-z]\.)"   # 单字母缩写（不含代词 i）
+        + r"|(?<=[.!?…][\"')\]])"                          # 句末标点后跟引号/括号
+        + rf"|(?<=[{EMOJI_CHARS}])"
+        + r")\s+",
+        re.IGNORECASE,   # 公开的分句后端，原始大小写的文本（"Mr. Smith"、"U.S. shipping"）也要识别缩写
+    )
+
+SENTENCE_BOUNDARY = build_sentence_boundary(SENTENCE_ABBREVIATIONS)
+
+def split_sentences_regex(texts):
+    parts = pd.Series(list(texts), dtype=object).fillna("").astype(str).str.strip().str.split(SENTENCE_BOUNDARY)
+    return [[p for p in sentences if p] for sentences in parts]
+
+def split_sentences_punkt(texts):
+    return [sent_tokenize(text) for text in texts]
+
+SENTENCE_SPLITTERS = {"punkt": split_sentences_punkt, "regex": split_sentences_regex}
+
+def split_sentences(texts, splitter="punkt"):
+    """批量分句：texts 为评论序列，返回与之一一对应的句子列表。"""
+    return SENTENCE_SPLITTERS[splitter](texts)
+
+SPLIT_BATCH_SIZE = 5000
+
+def iter_split_sentences(texts, splitter="punkt", prepare=None):
+    """
+    分批整列切分，逐条产出；texts 可以是任意可迭代对象，每次只取出一批，流式场景下内存只与批大小有关。
+    prepare: 可选的逐批预处理（如小写化），作用在该批的 Series 上，避免先复制整列。
+    """
+    iterator = iter(texts)
+    while batch := list(itertools.islice(iterator, SPLIT_BATCH_SIZE)):
+        if prepare is not None:
+            batch = prepare(pd.Series(batch, dtype=object)).tolist()
+        yield from split_sentences(batch, splitter)
+
+def compare_sentence_splitters(texts, candidate="regex", reference="punkt"):
+    """逐条对比两种分句结果，返回 (一致率, 不一致明细)。比较时忽略句子首尾空白。"""
+    texts = list(texts)
+    ref = split_sentences(texts, reference)
+    cand = split_sentences(texts, candidate)
+    rows = [{"评论": text, f"{reference} 分句": " ‖ ".join(r), f"{candidate} 分句": " ‖ ".join(c),
+             f"{reference} 句数": len(r), f"{candidate} 句数": len(c)}
+            for text, r, c in zip(texts, ref, cand)
+            if [x.strip() for x in r] != [x.strip() for x in c]]
+    agreement = 1 - len(rows) / len(texts) if texts else 1.0
+    return agreement, pd.DataFrame(rows)
 
 # 设置页面宽度和标题
 st.set_page_config(page_title="酒精笔评论分析看板", layout="wide")
 
-@st.cache_data
-
-def calculate_nss_logic(df, mapping, sentiment_lib):
-
-    results = []
-
-    
-
-    # 1. 预处理正则表达式和情感库（只需生成一次，效率更高）
-
+# 预处理正则表达式和情感库：进程级缓存，多个数据集、多个分片共用同一份编译结果
+@st.cache_resource(show_spinner=False)
+def compile_nss_lexicon(mapping, sentiment_lib):
     patterns = {cat: re.compile(rf'\b{re.escape(cat.lower())}\b') for cat in mapping.keys()}
-
     processed_lib = {}
-
     for cat in mapping.keys():
-
         target_key = cat
-
         while isinstance(sentiment_lib.get(target_key), str):
-
             target_key = sentiment_lib[target_key]
-
         lib_data = sentiment_lib.get(target_key, {"正面": [], "负面": []})
-
         processed_lib[cat] = {"pos": set(lib_data["正面"]), "neg": set(lib_data["负面"])}
+    return patterns, processed_lib
+
+@st.cache_resource(show_spinner=False)
+def compile_age_patterns(age_mapping):
+    return {label: [re.compile(rf'\b{re.escape(word.lower())}\b') for word in words]
+            for label, words in age_mapping.items()}
+
+# 单句情感判定：否定词库优先，其次正面词库（带否定词则反转），都没命中再交给 TextBlob
+def score_sentence(sentence, lib):
+    score = 0
+    negations = {'not', 'no', 'never', 'bad', "don't", "doesn't"}
+    has_negation = any(neg in sentence for neg in negations)
+
+    if any(n in sentence for n in lib["neg"]):
+        score = -1
+    elif any(p in sentence for p in lib["pos"]):
+        score = -1 if has_negation else 1
+
+    if score == 0:
+        pol = TextBlob(sentence).sentiment.polarity
+        if pol > 0.2: score = 1
+        elif pol < -0.1: score = -1
+    return score
+
+def match_age_labels(review, compiled_patterns):
+    matched = set()
+    for label, patterns in compiled_patterns.items():
+        for p in patterns:
+            if p.search(review):
+                matched.add(label)
+                break # 命中该标签的一个词就够了，不用再看这个标签的其他词
+    return matched
+
+@st.cache_data
+
+def calculate_nss_logic(df, mapping, sentiment_lib):
+
+    results = []
+
+    # 1. 预处理正则表达式和情感库（只需生成一次，效率更高）
+    patterns, processed_lib = compile_nss_lexicon(mapping, sentiment_lib)
 
 
     # 2. 核心改动：按 ASIN 进行分组遍历
@@ -66,19 +183,7 @@ def calculate_nss_logic(df, mapping, sentiment_lib):
             for sentence in asin_sentences:
                 if pattern.search(sentence):
                     total_hit += 1
-                    score = 0
-                    negations = {'not', 'no', 'never', 'bad', "don't", "doesn't"}
-                    has_negation = any(neg in sentence for neg in negations)
-
-                    if any(n in sentence for n in lib["neg"]):
-                        score = -1
-                    elif any(p in sentence for p in lib["pos"]):
-                        score = -1 if has_negation else 1
-                    
-                    if score == 0:
-                        pol = TextBlob(sentence).sentiment.polarity
-                        if pol > 0.2: score = 1
-                        elif pol < -0.1: score = -1
+                    score = score_sentence(sentence, lib)
 
                     if score == 1: pos_count += 1
                     elif score == -1: neg_count += 1
@@ -103,14 +208,7 @@ def calculate_nss_monthly_trend(df, mapping, sentiment_lib):
     df['Month_Str'] = df['Month'].astype(str)
     
     # 1. 预处理正则表达式和情感库
-    patterns = {cat: re.compile(rf'\b{re.escape(cat.lower())}\b') for cat in mapping.keys()}
-    processed_lib = {}
-    for cat in mapping.keys():
-        target_key = cat
-        while isinstance(sentiment_lib.get(target_key), str):
-            target_key = sentiment_lib[target_key]
-        lib_data = sentiment_lib.get(target_key, {"正面": [], "负面": []})
-        processed_lib[cat] = {"pos": set(lib_data["正面"]), "neg": set(lib_data["负面"])}
+    patterns, processed_lib = compile_nss_lexicon(mapping, sentiment_lib)
 
     # 2. 核心：按 [ASIN, Month_Str] 双重分组
     for (asin, month), group in df.groupby(['ASIN', 'Month_Str']):
@@ -128,15 +226,7 @@ def calculate_nss_monthly_trend(df, mapping, sentiment_lib):
                 if pattern.search(sentence):
                     total_hit += 1
                     # --- 复用你原有的判定逻辑 ---
-                    score = 0
-                    negations = {'not', 'no', 'never', 'bad', "don't", "doesn't"}
-                    has_negation = any(neg in sentence for neg in negations)
-                    if any(n in sentence for n in lib["neg"]): score = -1
-                    elif any(p in sentence for p in lib["pos"]): score = -1 if has_negation else 1
-                    if score == 0:
-                        pol = TextBlob(sentence).sentiment.polarity
-                        if pol > 0.2: score = 1
-                        elif pol < -0.1: score = -1
+                    score = score_sentence(sentence, lib)
                     if score == 1: pos_count += 1
                     elif score == -1: neg_count += 1
 
@@ -153,8 +243,7 @@ def calculate_nss_monthly_trend(df, mapping, sentiment_lib):
 def calculate_age_distribution(df, age_mapping):
     results = []
     # 提前编译正则，提高效率
-    compiled_patterns = {label: [re.compile(rf'\b{re.escape(word.lower())}\b') for word in words] 
-                         for label, words in age_mapping.items()}
+    compiled_patterns = compile_age_patterns(age_mapping)
     
     for asin, group in df.groupby('ASIN'):
         # 这里的计数单位变成了“评论条数”
@@ -163,13 +252,7 @@ def calculate_age_distribution(df, age_mapping):
         
         # 遍历每一条评论
         for review in group['Review Content'].fillna("").astype(str).str.lower():
-            matched_labels_for_this_review = set() # 用集合记录这条评论命中了哪些标签
-            
-            for label, patterns in compiled_patterns.items():
-                for p in patterns:
-                    if p.search(review):
-                        matched_labels_for_this_review.add(label)
-                        break # 命中该标签的一个词就够了，不用再看这个标签的其他词
+            matched_labels_for_this_review = match_age_labels(review, compiled_patterns) # 用集合记录这条评论命中了哪些标签
             
             # 如果这条评论有命中任何标签
             if matched_labels_for_this_review:
@@ -184,6 +267,7 @@ def calculate_age_distribution(df, age_mapping):
                     "ASIN": asin,
                     "年龄段": label,
                     "提及评论数": cnt, # 这里的单位变了，更科学
+                    "识别评论数": total_review_count, # 占比的分母，用于计算置信区间
                     "占比 (%)": round(cnt / total_review_count * 100, 1)
                 })
     return pd.DataFrame(results)
@@ -740,13 +824,17 @@ def get_title_keywords(title):
 
 # --- 2. 核心分析逻辑 ---
 
-def perform_analysis(df, mode="exact"):
+def perform_analysis(df, mode="exact", dedup=False):
     """
     mode: "exact" 使用自动生成的 top_kws 进行词对词匹配
     mode: "fuzzy" 使用 EXTENDED_MAPPING 进行语义丛匹配
+    dedup: True 时相同的评论文本只做一次正则匹配，再按出现次数计回
     """
     df['Title'] = df['Title'].fillna('').astype(str).str.lower()
     df['Review Content'] = df['Review Content'].fillna('').astype(str).str.lower()
+    if dedup:
+        text_codes, unique_reviews = pd.factorize(df['Review Content'])
+        df['_text_id'] = text_codes
     
     total_asins = df['ASIN'].nunique()
     asin_level_df = df.groupby('ASIN')['Title'].first().reset_index()
@@ -787,7 +875,13 @@ def perform_analysis(df, mode="exact"):
             extra_info = ", ".join(synonyms[:3]) + "..."
 
         # 4. 计算指标
-        review_mentions = relevant_reviews_series.str.contains(match_pattern, na=False).sum()
+        if dedup:
+            relevant_ids = pd.concat([asin_groups[a]['_text_id'] for a in relevant_asins]).to_numpy()
+            ids, copies = np.unique(relevant_ids, return_counts=True)
+            hits = pd.Series(unique_reviews[ids]).str.contains(match_pattern, na=False).to_numpy()
+            review_mentions = copies[hits].sum()
+        else:
+            review_mentions = relevant_reviews_series.str.contains(match_pattern, na=False).sum()
         review_echo_rate = (review_mentions / specific_total_reviews * 100) if specific_total_reviews > 0 else 0
         conversion = review_echo_rate / title_penetration if title_penetration > 0 else 0
 
@@ -804,223 +898,2588 @@ def perform_analysis(df, mode="exact"):
 
     return pd.DataFrame(analysis_data).sort_values("评论回声率 (%)", ascending=False)
 
+# --- 2.1 后台计算调度 ---
+NSS_SHARD_SIZE = 20    # NSS 按 ASIN 分片计算，每片包含的 ASIN 数
+POLL_INTERVAL = 1.0    # 后台任务未完成时，各板块的自动刷新间隔（秒）
+PRECISE_MAPPING = {k: [k] for k in EXTENDED_MAPPING.keys()}
+
+@st.cache_resource
+def get_analysis_executor():
+    # 进程级共享线程池：上传后立即提交任务，页面各板块按完成顺序渲染
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="analysis")
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def load_uploaded_file(file_name, fingerprint, _file_bytes):
+    # 按文件指纹缓存、各会话共用同一个 DataFrame（不复制，调用方只读）；原始字节不参与哈希
+    if file_name.endswith('.csv'):
+        return pd.read_csv(io.BytesIO(_file_bytes))
+    return pd.read_excel(io.BytesIO(_file_bytes))
+
+def get_dataset_fingerprint(file_bytes):
+    return hashlib.md5(file_bytes).hexdigest()
+
+def analysis_fingerprint(fingerprint, preview_size=None, family_dedup=False, engine=None):
+    # 文件指纹 + 计算口径，作为任务与共享缓存的键
+    fingerprint = f"{fingerprint}:{engine or DEFAULT_ENGINE}"
+    if family_dedup:
+        fingerprint += ":family"
+    if preview_size:
+        fingerprint += f":preview:{preview_size}"
+    return fingerprint
+
+def submit_analysis_jobs(df, fingerprint, preview_size=None, family_dedup=False, engine=None):
+    """
+    同一份数据（按文件指纹判断）只提交一次；换文件时取消旧数据尚未开始的任务。
+    NSS 按 ASIN 分片提交，前端每完成一片就能多画一部分。
+    preview_size: 预览模式下每个 ASIN（趋势为每个 ASIN×月份）最多抽取的评论条数，None 为完整计算。
+    family_dedup: 同一父体家族内的重复评论只计一次。
+    engine: ANALYSIS_ENGINES 中的计算引擎，默认 DEFAULT_ENGINE。
+    """
+    fingerprint = analysis_fingerprint(fingerprint, preview_size, family_dedup, engine)
+    all_jobs = st.session_state.setdefault("analysis_jobs", {})
+    if fingerprint not in all_jobs:
+        all_jobs[fingerprint] = build_analysis_jobs(df, fingerprint, preview_size, family_dedup, engine)
+    return all_jobs[fingerprint]
+
+def build_analysis_jobs(df, fingerprint, preview_size=None, family_dedup=False, engine=None):
+    # 不依赖会话状态，看板与本地 API 共用；相同 fingerprint 的任务经共享缓存只算一次
+    engine = engine or DEFAULT_ENGINE
+    executor, cache = get_analysis_executor(), get_shared_cache()
+    funcs = ANALYSIS_ENGINES[engine]
+    cache_keys = []
+
+    def submit(name, fn, *args):
+        key = f"{LEXICON_VERSION}/{fingerprint}/{name}"
+        cache_keys.append(key)
+        return SharedJob(cache, key, executor, fn, *args)
+
+    if family_dedup:
+        df = drop_family_duplicates(df)
+    asins = sorted(df['ASIN'].dropna().unique().tolist())
+    # 去重类引擎（dedup / dedup-regex）按家族排序分片，跨变体的重复评论才能在同一分片内去重
+    shard_order = order_asins_by_family(df) if engine != "reference" else asins
+    shards = [shard_order[i:i + NSS_SHARD_SIZE] for i in range(0, len(shard_order), NSS_SHARD_SIZE)]
+
+    # 预览模式：情感与年龄只跑分层样本；营销表本身是向量化扫描，仍用全量
+    scoring_df, trend_df = df, df
+    if preview_size:
+        scoring_df = stratified_sample(df, 'ASIN', preview_size)
+        trend_df = stratified_sample(df, ['ASIN', 'Month'] if 'Month' in df.columns else 'ASIN', preview_size)
+
+    # 共享评分：每个分片的唯一文本只分句、评分一次（预览模式下两份样本的文本一起评分），
+    # NSS 分片、趋势、共现都从这些计分表汇总，不再各自重跑 TextBlob。分片在执行时才切出来，句柄不持有分片副本
+    score_df = scoring_df if trend_df is scoring_df else pd.concat([scoring_df, trend_df])
+    categories = list(PRECISE_MAPPING.keys())
+    score_shards = [submit(f"scores/{i}", lambda s=s: score_review_texts(score_df[score_df['ASIN'].isin(s)],
+                                                                         PRECISE_MAPPING, SENTIMENT_LIB, funcs["splitter"]))
+                    for i, s in enumerate(shards)]
+    # 下面的汇总任务本身运行在线程池里，取计分表必须走 result_inline()，不能在池内阻塞等待
+    all_scores = lambda: [job.result_inline() for job in score_shards]
+
+    def nss_shard(s, scores_job):
+        shard_df = scoring_df[scoring_df['ASIN'].isin(s)]
+        if engine == "reference":
+            return funcs["nss"](shard_df, PRECISE_MAPPING, SENTIMENT_LIB)
+        return nss_from_text_scores(shard_df, [scores_job.result_inline()], categories)
+
+    jobs = {
+        "fingerprint": fingerprint,
+        "asins": asins,
+        "preview": {"size": preview_size, "rows": len(scoring_df)} if preview_size else None,
+        # perform_analysis 会原地改写 Title/Review Content，必须传副本，避免和其它线程互相干扰
+        "exact": submit("exact", lambda: funcs["marketing"](df.copy(), "exact")),
+        "fuzzy": submit("fuzzy", lambda: funcs["marketing"](df.copy(), "fuzzy")),
+        "age": submit("age", funcs["age"], scoring_df, AGE_DEMOGRAPHICS_LIB),
+        "nss_shards": [submit(f"nss/{i}", nss_shard, s, scores_job) for i, (s, scores_job) in enumerate(zip(shards, score_shards))],
+        # 趋势保存最细粒度的计数器，分桶与滚动窗口在展示时完成
+        "trend": (submit("trend", lambda: trend_counters_from_scores(trend_df, all_scores(), categories))
+                  if has_trend_dates(df) else None),
+        "day_level_dates": has_day_level_dates(df),
+        "undated_rows": count_undated_rows(trend_df),
+        "phrases": submit("phrases", discover_phrase_gaps, scoring_df, EXTENDED_MAPPING, SENTIMENT_LIB,
+                          PHRASE_TOP_K, funcs["splitter"]),
+        "cooccurrence": submit("cooccurrence", lambda: build_mention_matrices(scoring_df, all_scores(), categories)),
+    }
+    jobs["cache_keys"] = cache_keys
+    return jobs
+
+def prune_analysis_jobs(active_jobs):
+    # 已移除的文件、已切换模式的数据集：取消尚未开始的任务并释放结果
+    keep = {jobs["fingerprint"] for jobs in active_jobs}
+    all_jobs = st.session_state.get("analysis_jobs", {})
+    cache = get_shared_cache()
+    for fingerprint in list(all_jobs):
+        if fingerprint not in keep:
+            # 任务可能同时被其它会话使用，交给共享缓存按引用数决定是否取消
+            for key in all_jobs.pop(fingerprint)["cache_keys"]:
+                cache.release(key)
+
+def load_datasets(uploaded_files):
+    """多文件并发解析，返回 {数据集名: (DataFrame, 文件指纹)}；重名文件自动加序号区分。"""
+    payloads = [(f.name, get_dataset_fingerprint(f.getvalue()), f.getvalue()) for f in uploaded_files]
+    # 解析用独立的临时线程池，避免排在其它数据集的长任务后面
+    with ThreadPoolExecutor(max_workers=len(payloads)) as pool:
+        frames = list(pool.map(lambda p: load_uploaded_file(*p), payloads))
+
+    datasets = {}
+    for (name, fingerprint, _), df in zip(payloads, frames):
+        label, n = name, 2
+        while label in datasets:
+            label, n = f"{name} ({n})", n + 1
+        datasets[label] = (df, fingerprint)
+    return datasets
+
+def collect_nss_results(jobs):
+    # 拼接已完成的 NSS 分片，返回 (结果表, 已完成分片数)
+    done_results = [f.result() for f in jobs["nss_shards"] if f.done()]
+    nss_results = pd.concat(done_results, ignore_index=True) if done_results else pd.DataFrame()
+    return nss_results, len(done_results)
+
+def render_progressive(render_fn, futures, *args):
+    # 任务未完成时以 fragment 形式轮询刷新，只重绘本板块；板块内的下拉框交互也只重跑本板块
+    pending = any(not f.done() for f in futures if f is not None)
+    st.fragment(render_fn, run_every=POLL_INTERVAL if pending else None)(*args, pending)
+
+def finish_polling(polling):
+    # 轮询中的板块发现任务全部完成后，整页重跑一次以关闭自动刷新
+    if polling:
+        st.rerun()
+
+# --- 2.2 快速预览：分层抽样 + 置信区间 ---
+PREVIEW_DEFAULT_SIZE = 200      # 预览模式下每个分层默认抽取的评论条数
+PREVIEW_MIN_CELL = 30           # 样本中提及句子数/识别评论数低于该值的格子标记为“样本不足”
+PREVIEW_BOOTSTRAP_ROUNDS = 500
+PREVIEW_BOOTSTRAP_CHUNK = 2000  # 自助法每批处理的格子数，控制 (格子数 × 轮数) 矩阵的内存
+
+def stratified_sample(df, by, per_group, seed=42):
+    # 打乱行序后每个分层取前 per_group 条；后续评分成本只取决于样本量
+    rng = np.random.default_rng(seed)
+    shuffled = df.iloc[rng.permutation(len(df))]
+    return shuffled[shuffled.groupby(by, dropna=False).cumcount() < per_group].sort_index()
+
+def wilson_interval(successes, totals, z=1.96):
+    successes = np.asarray(successes, dtype=float)
+    totals = np.asarray(totals, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = successes / totals
+        denom = 1 + z ** 2 / totals
+        centre = (p + z ** 2 / (2 * totals)) / denom
+        half = z * np.sqrt(p * (1 - p) / totals + z ** 2 / (4 * totals ** 2)) / denom
+    return np.clip(centre - half, 0, 1), np.clip(centre + half, 0, 1)
+
+def bootstrap_nss_interval(pos, neg, hits, rounds=PREVIEW_BOOTSTRAP_ROUNDS, alpha=0.05, seed=42):
+    """
+    NSS 的参数化自助法区间：把每个格子看成 (正面, 负面, 中性) 的多项分布，
+    拆成两次条件二项抽样，所有格子按批向量化完成。
+    """
+    pos = np.asarray(pos, dtype=np.int64)
+    neg = np.asarray(neg, dtype=np.int64)
+    hits = np.asarray(hits, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    lower, upper = np.empty(len(hits)), np.empty(len(hits))
+
+    for start in range(0, len(hits), PREVIEW_BOOTSTRAP_CHUNK):
+        sl = slice(start, start + PREVIEW_BOOTSTRAP_CHUNK)
+        n = hits[sl][:, None]
+        p_pos = pos[sl] / hits[sl]
+        rest_share = 1 - p_pos
+        p_neg_given_rest = np.divide(neg[sl] / hits[sl], rest_share, out=np.zeros_like(p_pos), where=rest_share > 0)
+
+        pos_star = rng.binomial(n, p_pos[:, None], size=(len(p_pos), rounds))
+        neg_star = rng.binomial(n - pos_star, np.clip(p_neg_given_rest, 0, 1)[:, None])
+        nss_star = (pos_star - neg_star) / n
+        lower[sl], upper[sl] = np.quantile(nss_star, [alpha / 2, 1 - alpha / 2], axis=1)
+    return lower, upper
+
+def add_nss_confidence(nss_df):
+    nss_df = nss_df.copy()
+    lower, upper = bootstrap_nss_interval(nss_df["正面次数"], nss_df["负面次数"], nss_df["提及句子数"])
+    nss_df["NSS下限"] = lower.round(3)
+    nss_df["NSS上限"] = upper.round(3)
+    nss_df["样本不足"] = nss_df["提及句子数"] < PREVIEW_MIN_CELL
+    return nss_df
+
+def add_share_confidence(age_df, total_col):
+    age_df = age_df.copy()
+    lower, upper = wilson_interval(age_df["提及评论数"], age_df[total_col])
+    age_df["占比下限 (%)"] = (lower * 100).round(1)
+    age_df["占比上限 (%)"] = (upper * 100).round(1)
+    age_df["样本不足"] = age_df[total_col] < PREVIEW_MIN_CELL
+    return age_df
+
+# --- 2.3 词库缺口发现：流式高频短语 ---
+PHRASE_MAX_N = 4                 # 统计 1~4 词短语
+PHRASE_TOP_K = 200               # 最终输出的高频短语数，候选集最多保留 2 倍
+PHRASE_CHUNK_SIZE = 50000        # 每攒够这么多个短语就批量写入一次计数器，缓冲区大小固定
+PHRASE_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:['’][a-z]+)?")
+PHRASE_STOP_WORDS = {
+    'a', 'an', 'the', 'and', 'or', 'but', 'so', 'to', 'of', 'in', 'on', 'at', 'for', 'with', 'it', 'its',
+    'is', 'are', 'was', 'were', 'be', 'been', 'i', 'my', 'me', 'we', 'you', 'they', 'them', 'this', 'that',
+    'these', 'those', 'as', 'if', 'than', 'then', 'very', 'just', 'have', 'has', 'had', 'do', 'did', 'am'
+}
+
+class CountMinSketch:
+    """固定内存的近似计数器：depth × width 个计数格，估计值只会偏高，偏高幅度约为 e/width × 总数。"""
+
+    def __init__(self, width=1 << 16, depth=4, seed=42):
+        if width & (width - 1):
+            raise ValueError("width 需为 2 的幂")
+        rng = np.random.default_rng(seed)
+        self.width, self.depth = width, depth
+        self.total = 0
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        # 每行独立的 multiply-shift 哈希：64 位基础哈希乘以各行的随机奇数（按 2^64 取模），取高位作为列号。
+        # 不能取低位：低位只由基础哈希的低位决定，各行会在同一对键上一起碰撞
+        self._a = rng.integers(0, 1 << 63, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._shift = np.uint64(64 - (width.bit_length() - 1))
+
+    def _indexes(self, keys):
+        x = np.fromiter((int.from_bytes(hashlib.blake2b(k.encode('utf-8'), digest_size=8).digest(), 'little')
+                         for k in keys), dtype=np.uint64, count=len(keys))
+        return ((self._a[:, None] * x[None, :]) >> self._shift).astype(np.int64)
+
+    def add(self, keys):
+        if not keys:
+            return
+        idx = self._indexes(keys)
+        for d in range(self.depth):
+            self.table[d] += np.bincount(idx[d], minlength=self.width)
+        self.total += len(keys)
+
+    def query(self, keys):
+        if not keys:
+            return np.zeros(0, dtype=np.int64)
+        idx = self._indexes(keys)
+        return self.table[np.arange(self.depth)[:, None], idx].min(axis=0)
+
+    def error_bound(self):
+        return int(np.ceil(np.e / self.width * self.total))
+
+def tokenize_phrase(text):
+    return PHRASE_TOKEN_PATTERN.findall(text.lower())
+
+@st.cache_resource(show_spinner=False)
+def build_lexicon_ngrams(mapping, sentiment_lib):
+    # 词库里每个词条的所有连续子短语；短语落在这个集合里就算“已被词库覆盖”
+    terms = set()
+    for key, synonyms in mapping.items():
+        terms.add(str(key))
+        terms.update(str(w) for w in synonyms)
+    for value in sentiment_lib.values():
+        if isinstance(value, dict):
+            terms.update(value["正面"])
+            terms.update(value["负面"])
+
+    covered = set()
+    for term in terms:
+        tokens = tokenize_phrase(term)
+        for n in range(1, PHRASE_MAX_N + 1):
+            for i in range(len(tokens) - n + 1):
+                covered.add(" ".join(tokens[i:i + n]))
+    return covered
+
+def iter_sentence_ngrams(sentence):
+    tokens = tokenize_phrase(sentence)
+    for n in range(1, PHRASE_MAX_N + 1):
+        for i in range(len(tokens) - n + 1):
+            # 首尾是停用词的短语没有信息量，直接跳过
+            if tokens[i] in PHRASE_STOP_WORDS or tokens[i + n - 1] in PHRASE_STOP_WORDS:
+                continue
+            yield " ".join(tokens[i:i + n])
+
+def discover_phrase_gaps(df, mapping, sentiment_lib, top_k=PHRASE_TOP_K, splitter="punkt"):
+    """
+    流式扫描全部评论句子，找出词库（EXTENDED_MAPPING 同义词 + SENTIMENT_LIB 短语）没有覆盖的高频短语。
+    全局计数用 Count-Min Sketch，候选集只保留 2×top_k 个；按 ASIN 的次数只对候选短语精确计数，
+    内存上限为 候选数 × ASIN 数，与评论条数无关。
+    """
+    covered = build_lexicon_ngrams(mapping, sentiment_lib)
+    category_keys = {str(k).lower() for k in mapping.keys()}
+    phrase_sketch = CountMinSketch()
+    candidates = {}
+    asin_counts = {}   # 候选短语 -> Counter(ASIN -> 精确次数)
+    missed = {}        # 候选短语进入候选集之前、已流过的出现次数上限（0 表示按 ASIN 计数完整）
+    buffer, asin_buffer = [], []
+
+    def flush():
+        phrase_sketch.add(buffer)
+        chunk_counts = Counter(buffer)
+        unique_phrases = list(chunk_counts)
+        candidates.update(zip(unique_phrases, phrase_sketch.query(unique_phrases).tolist()))
+        if len(candidates) > 2 * top_k:
+            kept = heapq.nlargest(top_k, candidates.items(), key=lambda kv: kv[1])
+            candidates.clear()
+            candidates.update(kept)
+            for phrase in [p for p in asin_counts if p not in candidates]:
+                del asin_counts[phrase], missed[phrase]
+        for phrase in unique_phrases:
+            if phrase in candidates and phrase not in asin_counts:
+                asin_counts[phrase] = Counter()
+                missed[phrase] = max(candidates[phrase] - chunk_counts[phrase], 0)
+        for asin, phrase in zip(asin_buffer, buffer):
+            if phrase in asin_counts:
+                asin_counts[phrase][asin] += 1
+        buffer.clear()
+        asin_buffer.clear()
+
+    # 小写化随分句逐批进行，不另复制整列评论
+    lower = lambda batch: batch.fillna("").astype(str).str.lower()
+    for asin, sentences in zip(df['ASIN'], iter_split_sentences(df['Review Content'], splitter, prepare=lower)):
+        for sentence in sentences:
+            for phrase in iter_sentence_ngrams(sentence):
+                if phrase in covered:
+                    continue
+                buffer.append(phrase)
+                asin_buffer.append(asin)
+        if len(buffer) >= PHRASE_CHUNK_SIZE:
+            flush()
+    flush()
+
+    phrases = list(candidates.keys())
+    estimates = phrase_sketch.query(phrases)
+    top = pd.DataFrame({"短语": phrases, "估计出现次数": estimates})
+    top = top.sort_values("估计出现次数", ascending=False).head(top_k).reset_index(drop=True)
+    top["词数"] = top["短语"].str.count(" ") + 1
+    top["关联维度"] = top["短语"].apply(lambda p: ", ".join(sorted(set(p.split()) & category_keys)) or "-")
+
+    kept = set(top["短语"])
+    return {
+        "top": top,
+        "asin_counts": {p: c for p, c in asin_counts.items() if p in kept},
+        "missed": {p: m for p, m in missed.items() if p in kept},
+        "error_bound": phrase_sketch.error_bound(),
+    }
+
+def phrase_gaps_for_asin(gaps, asin):
+    # 该 ASIN 次数为精确计数；短语中途才进入候选集时只统计了之后的部分，“可能漏计”给出漏掉次数的上限
+    phrases = gaps["top"]["短语"].tolist()
+    counts = [gaps["asin_counts"].get(p, {}).get(asin, 0) for p in phrases]
+    missed = [gaps["missed"].get(p, 0) for p in phrases]
+    result = gaps["top"][["短语", "词数", "关联维度"]].assign(**{"该 ASIN 次数": counts, "可能漏计": missed})
+    return result[result["该 ASIN 次数"] > 0].sort_values("该 ASIN 次数", ascending=False)
+
+# --- 2.4 多数据集对比 ---
+def summarize_nss_by_dimension(nss_results):
+    # 跨 ASIN 合并计数后再算 NSS，避免小 ASIN 和大 ASIN 等权
+    agg = nss_results.groupby("维度")[["提及句子数", "正面次数", "负面次数"]].sum()
+    agg["NSS分数"] = ((agg["正面次数"] - agg["负面次数"]) / agg["提及句子数"]).round(3)
+    return agg.reset_index()
+
+AGE_SHARE_NOTE = "占比 = 提及该年龄段的评论数 ÷ 识别出任一年龄段的评论数；一条评论可命中多个年龄段，各占比之和可能超过 100%。"
+
+def summarize_age_shares(age_results):
+    # 全量年龄占比：年龄板块的“全部”视图与多数据集对比共用同一口径（AGE_SHARE_NOTE）
+    summary = age_results.groupby("年龄段")["提及评论数"].sum().reset_index()
+    # 识别评论数每个 ASIN 一份，多标签评论只算一条
+    summary["识别评论数"] = age_results.drop_duplicates("ASIN")["识别评论数"].sum()
+    summary["占比 (%)"] = (summary["提及评论数"] / summary["识别评论数"] * 100).round(1)
+    return summary
+
+def build_comparison_table(frames, key, value, baseline):
+    """frames: {数据集名: DataFrame}，按 key 对齐 value 列，并给出每个数据集相对基准的差值。"""
+    table = pd.DataFrame({name: frame.set_index(key)[value] for name, frame in frames.items()})
+    for name in frames:
+        if name != baseline:
+            table[f"Δ {name} vs {baseline}"] = (table[name] - table[baseline]).round(3)
+    return table.rename_axis(key).reset_index()
+
+# --- 2.5 图表缓存 ---
+# 图表规格按 (数据指纹, ASIN, 维度) 缓存为 dict：无关下拉框触发重跑时不再重建 DataFrame 和 Figure。
+# 以下划线开头的参数不参与缓存键，数据本身由指纹代表。
+TREND_MAX_POINTS = 200            # 单维度趋势最多下发的点数，超出后服务端降采样
+TREND_TEXT_MAX_POINTS = 60        # 点数超过该值时不再逐点标注数值
+SMALL_MULTIPLE_MAX_POINTS = 36    # 小多图每个维度最多下发的点数
+SMALL_MULTIPLE_COLS = 4
+
+def downsample_lttb(y, max_points):
+    """Largest-Triangle-Three-Buckets 降采样，返回保留点的下标；保留峰谷形状，首尾点一定保留。"""
+    n = len(y)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+    y = np.asarray(y, dtype=float)
+    x = np.arange(n, dtype=float)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    keep = [0]
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        ax, ay = x[keep[-1]], y[keep[-1]]
+        area = np.abs((ax - avg_x) * (y[start:end] - ay) - (ax - x[start:end]) * (avg_y - ay))
+        keep.append(start + int(area.argmax()))
+    keep.append(n - 1)
+    return np.array(keep)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def build_nss_view(fingerprint, done_count, selected_asin, preview, _nss_results):
+    # done_count 进入缓存键：分片陆续完成时图表会跟着刷新
+    nss_results = _nss_results
+    if selected_asin == "全部":
+        display_df = nss_results.groupby("维度").agg({
+            "提及句子数": "sum", "正面次数": "sum", "负面次数": "sum", "NSS分数": "mean"
+        }).reset_index()
+        plot_title = "全品类平均口碑概览 (NSS)"
+    else:
+        display_df = nss_results[nss_results['ASIN'] == selected_asin]
+        plot_title = f"ASIN: {selected_asin} 专项口碑诊断"
+
+    # 预览模式：单个 ASIN 的每个格子都带自助法置信区间，并标记样本不足
+    error_cols = {}
+    if preview and selected_asin != "全部":
+        display_df = add_nss_confidence(display_df)
+        display_df["误差上"] = display_df["NSS上限"] - display_df["NSS分数"]
+        display_df["误差下"] = display_df["NSS分数"] - display_df["NSS下限"]
+        error_cols = {"error_x": "误差上", "error_x_minus": "误差下"}
+        plot_title += "（抽样预览，95% 置信区间）"
+
+    display_df = display_df.sort_values("NSS分数", ascending=True)
+    dynamic_height = max(500, len(display_df) * 25)
+    fig = px.bar(display_df, x="NSS分数", y="维度", orientation='h', color="NSS分数",
+                 color_continuous_scale='RdYlGn', range_color=[-1, 1], text_auto=".2f", height=dynamic_height,
+                 **error_cols)
+    fig.update_layout(margin=dict(l=150, r=20, t=50, b=50))
+    return display_df.drop(columns=list(error_cols.values())), plot_title, fig.to_dict()
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def build_trend_line_spec(fingerprint, asin, dimension, freq_label, window, _bucketed):
+    plot_df = rolling_nss_series(fingerprint, TREND_FREQS[freq_label], asin, dimension, window, _bucketed)
+    if plot_df["提及句子数"].sum() == 0:
+        return None
+
+    # 长序列：服务端 LTTB 降采样 + WebGL 渲染，下发给浏览器的点数有上限；无提及的周期保留为空值，横轴保持连续
+    keep = downsample_lttb(plot_df["NSS分数"].fillna(0).to_numpy(), TREND_MAX_POINTS)
+    plot_df = plot_df.iloc[keep]
+    show_text = len(plot_df) <= TREND_TEXT_MAX_POINTS
+    window_label = f"滚动 {window} {freq_label}" if window > 1 else f"按{freq_label}"
+    fig_line = px.line(plot_df, x="周期", y="NSS分数", text="NSS分数" if show_text else None, markers=True,
+                       hover_data=["提及句子数"],
+                       title=f"【{asin}】在【{dimension}】维度的 NSS 趋势（{window_label}）",
+                       range_y=[-1.1, 1.1], template="plotly_white", render_mode="webgl")
+    fig_line.add_hline(y=0, line_dash="dash", line_color="red")
+    fig_line.update_traces(line_width=3, marker_size=8, textposition="top center")
+    fig_line.update_xaxes(type='category', tickangle=45)
+    return fig_line.to_dict()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_trend_small_multiples_spec(fingerprint, asin, freq_label, window, _bucketed):
+    freq = TREND_FREQS[freq_label]
+    dimensions = sorted(dim for a, dim in _bucketed["index"] if a == asin)
+    parts = []
+    for dimension in dimensions:
+        series = rolling_nss_series(fingerprint, freq, asin, dimension, window, _bucketed)
+        keep = downsample_lttb(series["NSS分数"].fillna(0).to_numpy(), SMALL_MULTIPLE_MAX_POINTS)
+        parts.append(series.iloc[keep].assign(维度=dimension))
+    plot_df = pd.concat(parts, ignore_index=True)
+
+    rows = -(-len(dimensions) // SMALL_MULTIPLE_COLS)
+    fig = px.line(plot_df, x="周期", y="NSS分数", facet_col="维度", facet_col_wrap=SMALL_MULTIPLE_COLS,
+                  facet_row_spacing=min(0.04, 0.5 / rows), range_y=[-1.1, 1.1], template="plotly_white",
+                  render_mode="webgl", height=max(300, rows * 160), title=f"【{asin}】全部维度 NSS 趋势")
+    fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+    fig.update_xaxes(type='category', showticklabels=False, title=None)
+    fig.update_yaxes(title=None)
+    return fig.to_dict()
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def build_age_view(fingerprint, age_selected_asin, preview, _age_results):
+    age_results = _age_results
+    if age_selected_asin == "全部":
+        display_age = summarize_age_shares(age_results)
+        age_plot_title = "全品类受众年龄分布"
+    else:
+        display_age = age_results[age_results['ASIN'] == age_selected_asin]
+        age_plot_title = f"ASIN: {age_selected_asin} 受众年龄画像"
+
+    if display_age.empty:
+        return display_age, None
+
+    # 预览模式：占比附带 Wilson 置信区间
+    error_cols = {}
+    if preview:
+        display_age = add_share_confidence(display_age, "识别评论数")
+        display_age["误差上"] = display_age["占比上限 (%)"] - display_age["占比 (%)"]
+        display_age["误差下"] = display_age["占比 (%)"] - display_age["占比下限 (%)"]
+        error_cols = {"error_x": "误差上", "error_x_minus": "误差下"}
+        age_plot_title += "（抽样预览，95% 置信区间）"
+
+    # 绘图：使用水平条形图，清晰展示层级
+    fig_age = px.bar(
+        display_age.sort_values("占比 (%)", ascending=True),
+        x="占比 (%)",
+        y="年龄段",
+        orientation='h',
+        text="占比 (%)",
+        title=age_plot_title,
+        color="年龄段",
+        color_discrete_sequence=px.colors.qualitative.Pastel,
+        **error_cols
+    )
+    return display_age, fig_age.to_dict()
+
+# --- 2.6 表格着色与分页 ---
+TABLE_PAGE_SIZE = 50
+GRADIENT_LEVELS = 256
+
+@st.cache_resource(show_spinner=False)
+def gradient_palette(cmap_name):
+    # 色带离散成 256 档 CSS，文字颜色按背景亮度取黑/白（与 pandas background_gradient 的阈值一致）
+    rgba = colormaps[cmap_name](np.linspace(0, 1, GRADIENT_LEVELS))
+    rgb = (rgba[:, :3] * 255).round().astype(int)
+    linear = np.where(rgba[:, :3] <= 0.04045, rgba[:, :3] / 12.92, ((rgba[:, :3] + 0.055) / 1.055) ** 2.4)
+    luminance = linear @ np.array([0.2126, 0.7152, 0.0722])
+    return np.array([f"background-color: #{r:02x}{g:02x}{b:02x}; color: {'#f1f1f1' if lum < 0.408 else '#000000'}"
+                     for (r, g, b), lum in zip(rgb, luminance)], dtype=object)
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def compute_table_colors(cache_key, gradients, _df):
+    """
+    gradients: ((列名, (色带, vmin, vmax)), ...)，vmin/vmax 为 None 时取该列的最小/最大值。
+    整列一次性向量化映射成 CSS 字符串数组（按行号对齐），翻页/排序/筛选时直接按行号取用，不再重新着色。
+    """
+    colors = {}
+    for col, (cmap_name, vmin, vmax) in gradients:
+        values = pd.to_numeric(_df[col], errors="coerce").to_numpy(dtype=float)
+        if np.isnan(values).all():
+            continue
+        lo = np.nanmin(values) if vmin is None else vmin
+        hi = np.nanmax(values) if vmax is None else vmax
+        norm = np.clip((values - lo) / (hi - lo), 0, 1) if hi > lo else np.full(len(values), 0.5)
+        levels = np.rint(np.nan_to_num(norm) * (GRADIENT_LEVELS - 1)).astype(int)
+        colors[col] = np.where(np.isnan(values), "", gradient_palette(cmap_name)[levels])
+    return colors
+
+def filter_and_sort_table(df, query, sort_col, ascending):
+    view = df
+    if query:
+        mask = np.zeros(len(df), dtype=bool)
+        for col in df.select_dtypes(include=["object", "string"]).columns:
+            mask |= df[col].astype(str).str.contains(query, case=False, regex=False, na=False).to_numpy()
+        view = view[mask]
+    if sort_col is not None:
+        view = view.sort_values(sort_col, ascending=ascending, kind="stable")
+    return view
+
+# top10产品：BS下没有标kid的前10个ASIN
+TOP10_NON_KID_ASINS = [
+    '',  # 请替换为实际的ASIN
+    'B07ZYFXLZ6',
+    'B07NRB5G3Q',
+    'B07VK1G863',
+    'B01GRF7NRY',
+    'B0D9B948GX',
+    'B08P4J7X8T',
+    'B0DJY2F84V',
+    'B09P7WS4P7',
+    'B08YDDCBDZ',
+    'B0D9GMMKHT'
+]
+
+def build_top10_child_table(age_results):
+    # 过滤出top10 ASIN的数据，专门看儿童占比
+    top10_data = age_results[age_results['ASIN'].isin(TOP10_NON_KID_ASINS)]
+    child_data = top10_data[top10_data['年龄段'] == "儿童/幼儿 (0-12岁)"]
+    return (child_data[["ASIN", "年龄段", "提及评论数", "占比 (%)"]]
+            .sort_values("占比 (%)", ascending=False)
+            .reset_index(drop=True))
+
+# --- 2.7 报告导出 ---
+EXPORT_CHUNK_ROWS = 50000
+EXCEL_MAX_ROWS = 1048575   # Excel 单个工作表的数据行上限（不含表头），超出后自动续写到新工作表
+
+def report_jobs_done(jobs):
+    futures = [jobs["exact"], jobs["fuzzy"], jobs["age"], jobs["trend"], *jobs["nss_shards"]]
+    return all(f.done() for f in futures if f is not None)
+
+def collect_report_tables(jobs):
+    # 直接读取后台任务的缓存结果，不重新计算
+    nss_results, _ = collect_nss_results(jobs)
+    age_results = jobs["age"].result()
+    return {
+        "词频精确匹配": jobs["exact"].result(),
+        "语义模糊匹配": jobs["fuzzy"].result(),
+        "ASIN维度NSS": nss_results,
+        "月度趋势": monthly_trend_table(jobs["trend"].result()) if jobs["trend"] is not None else pd.DataFrame(),
+        "年龄分布": age_results,
+        "Top10儿童占比": build_top10_child_table(age_results) if not age_results.empty else pd.DataFrame(),
+    }
+
+def iter_row_chunks(df):
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+        # NaN 在 Excel 中写成空单元格
+        yield chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+
+def write_excel_report(tables, path):
+    """openpyxl 只写模式：行写出后即落盘，内存占用与表的行数无关。"""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    for name, df in tables.items():
+        part, ws, rows_in_sheet = 1, None, EXCEL_MAX_ROWS
+        for rows in iter_row_chunks(df):
+            for row in rows:
+                if rows_in_sheet >= EXCEL_MAX_ROWS:
+                    ws = wb.create_sheet(title=name if part == 1 else f"{name}_{part}")
+                    ws.append(list(df.columns))
+                    part, rows_in_sheet = part + 1, 0
+                ws.append(list(row))
+                rows_in_sheet += 1
+        if ws is None:
+            wb.create_sheet(title=name).append(list(df.columns))
+    wb.save(path)
+
+def write_parquet_bundle(tables, path):
+    """每张表一个 Parquet 文件（按块写入 row group），最后打包成 zip。"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    with tempfile.TemporaryDirectory() as tmp_dir, zipfile.ZipFile(path, "w") as bundle:
+        for name, df in tables.items():
+            part_path = os.path.join(tmp_dir, f"{name}.parquet")
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            with pq.ParquetWriter(part_path, schema) as writer:
+                for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+                    chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+                    writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            bundle.write(part_path, arcname=f"{name}.parquet")
+
+EXPORT_FORMATS = {
+    "Excel (.xlsx)": (".xlsx", write_excel_report, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet (.zip)": (".zip", write_parquet_bundle, "application/zip"),
+}
+
+def export_report(jobs, export_format):
+    suffix, writer, _ = EXPORT_FORMATS[export_format]
+    fd, path = tempfile.mkstemp(prefix="alcohol_reviews_report_", suffix=suffix)
+    os.close(fd)
+    writer(collect_report_tables(jobs), path)
+    return path
+
+# --- 2.8 重复评论去重 ---
+# 同一父体下的变体 ASIN 会重复挂同一条评论。按文本去重后每条唯一文本只分句、评分一次，
+# 再按 (ASIN, 月份) 的出现次数把计数器加回去；逐条评分本身不变，结果与逐条计算完全一致。
+NSS_COUNT_COLS = ["提及句子数", "正面次数", "负面次数"]
+FAMILY_LINK_MIN_WORDS = 8   # 推断家族时只用足够长的评论连边；"great"、"love them!" 这类短评在不同品牌间也会撞车
+
+def normalize_review_text(reviews):
+    # 小写 + 去首尾空白：首尾空白不影响分句后的正则与短语匹配，不会改变评分
+    return reviews.fillna("").astype(str).str.lower().str.strip()
+
+def derive_review_families(df, text_keys):
+    """
+    父体家族：有 'Parent ASIN' 列时直接使用；否则把共享过同一条评论文本（至少 FAMILY_LINK_MIN_WORDS 个词）
+    的 ASIN 用并查集并成一组。
+    """
+    if 'Parent ASIN' in df.columns:
+        return df['Parent ASIN'].fillna(df['ASIN'])
+
+    pairs = pd.DataFrame({"ASIN": df['ASIN'].to_numpy(), "key": text_keys.to_numpy()})
+    pairs = pairs[pairs["ASIN"].notna()].drop_duplicates()
+    pairs = pairs[pairs["key"].str.count(r"\S+") >= FAMILY_LINK_MIN_WORDS]
+    pairs["root"] = pairs.groupby("key")["ASIN"].transform("first")
+    links = pairs.loc[pairs["root"] != pairs["ASIN"], ["root", "ASIN"]].drop_duplicates()
+
+    parent = {}
+    def find(a):
+        while parent.get(a, a) != a:
+            parent[a] = parent.get(parent[a], parent[a])
+            a = parent[a]
+        return a
+
+    for a, b in links.itertuples(index=False):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+    family_of = {a: find(a) for a in df['ASIN'].dropna().unique()}
+    return df['ASIN'].map(family_of)
+
+def drop_family_duplicates(df):
+    # 同一家族内相同的评论只保留第一条。空评论不参与去重；推断家族时短评也不参与，多半是不同买家各自写的
+    text_keys = normalize_review_text(df['Review Content'])
+    families = derive_review_families(df, text_keys)
+    duplicated = pd.DataFrame({"family": families.to_numpy(), "key": text_keys.to_numpy()}).duplicated()
+    min_words = 1 if 'Parent ASIN' in df.columns else FAMILY_LINK_MIN_WORDS
+    eligible = text_keys.str.count(r"\S+") >= min_words
+    return df[~(duplicated.to_numpy() & eligible.to_numpy())]
+
+def order_asins_by_family(df):
+    # NSS 分片按家族排序 ASIN，让同一父体的变体落在同一分片里，去重才能生效
+    families = derive_review_families(df, normalize_review_text(df['Review Content']))
+    order = pd.DataFrame({"family": families.astype(str), "ASIN": df['ASIN']}).dropna().drop_duplicates("ASIN")
+    return order.sort_values(["family", "ASIN"])["ASIN"].tolist()
+
+@st.cache_data(show_spinner=False)
+def count_unique_reviews(fingerprint, _df):
+    return normalize_review_text(_df['Review Content']).nunique()
+
+def score_unique_reviews_nss(unique_texts, mapping, sentiment_lib, splitter="punkt"):
+    patterns, processed_lib = compile_nss_lexicon(mapping, sentiment_lib)
+    records = []
+    for text_id, sentences in enumerate(split_sentences(unique_texts, splitter)):
+        if not sentences: continue
+        for category, pattern in patterns.items():
+            pos_count, neg_count, total_hit = 0, 0, 0
+            lib = processed_lib[category]
+            for sentence in sentences:
+                if pattern.search(sentence):
+                    total_hit += 1
+                    score = score_sentence(sentence, lib)
+                    if score == 1: pos_count += 1
+                    elif score == -1: neg_count += 1
+            if total_hit > 0:
+                records.append((text_id, category, total_hit, pos_count, neg_count))
+    return pd.DataFrame(records, columns=["text_id", "维度"] + NSS_COUNT_COLS)
+
+def aggregate_nss_counters(keys, text_ids, scores, group_cols, categories):
+    """keys: 每行评论的分组键（ASIN / 月份）；scores: 每个唯一文本的维度计数。按出现次数加权后汇总。"""
+    rows = keys.assign(text_id=text_ids)
+    copies = rows.groupby(group_cols + ["text_id"]).size().rename("copies").reset_index()
+    merged = copies.merge(scores, on="text_id")
+    merged[NSS_COUNT_COLS] = merged[NSS_COUNT_COLS].mul(merged["copies"], axis=0)
+    # 维度按词库顺序排列，与逐条计算的输出顺序一致
+    merged["维度"] = pd.Categorical(merged["维度"], categories=categories)
+    agg = merged.groupby(group_cols + ["维度"], observed=True)[NSS_COUNT_COLS].sum().reset_index()
+    agg["维度"] = agg["维度"].astype(str)
+    return agg
+
+def nss_score_column(agg):
+    return [round((p - n) / h, 3) for p, n, h in zip(agg["正面次数"], agg["负面次数"], agg["提及句子数"])]
+
+def score_review_texts(df, mapping, sentiment_lib, splitter="punkt"):
+    """共享评分任务：df 中每个唯一评论文本只分句、评分一次，返回以文本为键的维度计数表，NSS / 趋势 / 共现都从这里汇总。"""
+    _, unique_texts = pd.factorize(normalize_review_text(df['Review Content']))
+    scores = score_unique_reviews_nss(unique_texts, mapping, sentiment_lib, splitter)
+    scores.insert(0, "文本", unique_texts[scores.pop("text_id").to_numpy()])
+    return scores
+
+def attach_text_scores(df, score_tables):
+    """把一份或多份文本计分表对到 df 的唯一文本上，返回 (每行 text_id, 唯一文本, 以 text_id 为键的计分表)。"""
+    text_ids, unique_texts = pd.factorize(normalize_review_text(df['Review Content']))
+    scores = pd.concat(score_tables, ignore_index=True) if len(score_tables) > 1 else score_tables[0]
+    # 同一文本可能在多个分片里各评分一次（跨家族的重复评论），结果相同，只保留一份
+    scores = scores.drop_duplicates(["文本", "维度"])
+    ids = pd.Index(unique_texts).get_indexer(scores["文本"])
+    scores = scores.assign(text_id=ids).drop(columns="文本")[ids >= 0]
+    return text_ids, unique_texts, scores
+
+def nss_from_text_scores(df, score_tables, categories):
+    text_ids, _, scores = attach_text_scores(df, score_tables)
+    if scores.empty:
+        return pd.DataFrame()
+    agg = aggregate_nss_counters(df[['ASIN']], text_ids, scores, ['ASIN'], categories)
+    agg["NSS分数"] = nss_score_column(agg)
+    return agg
+
+def calculate_nss_logic_dedup(df, mapping, sentiment_lib, splitter="punkt"):
+    return nss_from_text_scores(df, [score_review_texts(df, mapping, sentiment_lib, splitter)], list(mapping.keys()))
+
+def calculate_nss_monthly_trend_dedup(df, mapping, sentiment_lib, splitter="punkt"):
+    text_ids, unique_texts = pd.factorize(normalize_review_text(df['Review Content']))
+    scores = score_unique_reviews_nss(unique_texts, mapping, sentiment_lib, splitter)
+    if scores.empty:
+        return pd.DataFrame()
+    keys = pd.DataFrame({"ASIN": df['ASIN'], "月份": df['Month'].astype(str)})
+    agg = aggregate_nss_counters(keys, text_ids, scores, ['ASIN', '月份'], list(mapping.keys()))
+    agg["NSS分数"] = nss_score_column(agg)
+    return agg[["ASIN", "月份", "维度", "NSS分数"]]
+
+def calculate_age_distribution_dedup(df, age_mapping):
+    text_ids, unique_texts = pd.factorize(normalize_review_text(df['Review Content']))
+    compiled_patterns = compile_age_patterns(age_mapping)
+    labels = pd.DataFrame([(text_id, label) for text_id, review in enumerate(unique_texts)
+                           for label in match_age_labels(review, compiled_patterns)],
+                          columns=["text_id", "年龄段"])
+    if labels.empty:
+        return pd.DataFrame()
+
+    copies = (pd.DataFrame({"ASIN": df['ASIN'], "text_id": text_ids})
+              .groupby(["ASIN", "text_id"]).size().rename("copies").reset_index())
+    # 命中任一标签的评论条数（占比分母）
+    totals = copies[copies["text_id"].isin(labels["text_id"])].groupby("ASIN")["copies"].sum()
+    counts = copies.merge(labels, on="text_id").groupby(["ASIN", "年龄段"])["copies"].sum()
+
+    grid = pd.MultiIndex.from_product([totals.index, list(age_mapping.keys())], names=["ASIN", "年龄段"])
+    result = counts.reindex(grid, fill_value=0).rename("提及评论数").reset_index()
+    result["识别评论数"] = result["ASIN"].map(totals)
+    result["占比 (%)"] = [round(c / t * 100, 1) for c, t in zip(result["提及评论数"], result["识别评论数"])]
+    return result
+
+# 可切换的计算引擎：reference 为逐条计算的原始实现；splitter 为该引擎使用的分句后端
+ANALYSIS_ENGINES = {
+    "dedup": {
+        "nss": calculate_nss_logic_dedup,
+        "trend": calculate_nss_monthly_trend_dedup,
+        "age": calculate_age_distribution_dedup,
+        "marketing": lambda df, mode: perform_analysis(df, mode, dedup=True),
+        "splitter": "punkt",
+    },
+    "dedup-regex": {
+        "nss": lambda df, mapping, lib: calculate_nss_logic_dedup(df, mapping, lib, splitter="regex"),
+        "trend": lambda df, mapping, lib: calculate_nss_monthly_trend_dedup(df, mapping, lib, splitter="regex"),
+        "age": calculate_age_distribution_dedup,
+        "marketing": lambda df, mode: perform_analysis(df, mode, dedup=True),
+        "splitter": "regex",
+    },
+    "reference": {
+        "nss": calculate_nss_logic,
+        "trend": calculate_nss_monthly_trend,
+        "age": calculate_age_distribution,
+        "marketing": perform_analysis,
+        "splitter": "punkt",
+    },
+}
+# 没有 punkt 数据包时只能使用正则分句的引擎
+AVAILABLE_ENGINES = [name for name, funcs in ANALYSIS_ENGINES.items() if PUNKT_AVAILABLE or funcs["splitter"] != "punkt"]
+DEFAULT_ENGINE = "dedup" if PUNKT_AVAILABLE else "dedup-regex"
+
+# --- 2.9 趋势分桶与滚动窗口 ---
+# 趋势任务只保存最细粒度（日期列存在时按天，否则按月）的 正面/负面/提及 计数器；
+# 切换周/月/季度只是对计数器重新汇总，滚动 N 期 NSS 由累计和数组相减得到，都不会重新扫描文本。
+DATE_COLUMNS = ["Date", "Review Date", "Review_Date", "date"]
+TREND_FREQS = {"周": "W", "月": "M", "季度": "Q"}
+TREND_MAX_WINDOW = 12
+
+def has_day_level_dates(df):
+    return any(col in df.columns for col in DATE_COLUMNS)
+
+def has_trend_dates(df):
+    return 'Month' in df.columns or has_day_level_dates(df)
+
+def resolve_review_dates(df):
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            return pd.to_datetime(df[col], errors="coerce").dt.normalize()
+    # Month 通常只有几十个不同取值：只解析唯一值，并逐个推断格式（"2024-01" 与 "Jan 2024" 混用也能识别）
+    labels = df['Month'].astype(str)
+    unique_labels = labels.unique()
+    parsed = pd.to_datetime(unique_labels, errors="coerce", format="mixed")
+    return labels.map(dict(zip(unique_labels, parsed)))
+
+def count_undated_rows(df):
+    # 日期缺失或无法解析的评论不进入趋势，看板上提示条数
+    return int(resolve_review_dates(df).isna().sum()) if has_trend_dates(df) else 0
+
+def trend_counters_from_scores(df, score_tables, categories):
+    text_ids, _, scores = attach_text_scores(df, score_tables)
+    if scores.empty:
+        return pd.DataFrame(columns=["ASIN", "日期", "维度"] + NSS_COUNT_COLS)
+    keys = pd.DataFrame({"ASIN": df['ASIN'], "日期": resolve_review_dates(df)})
+    return aggregate_nss_counters(keys, text_ids, scores, ['ASIN', '日期'], categories)
+
+def calculate_nss_trend_counters(df, mapping, sentiment_lib, splitter="punkt"):
+    return trend_counters_from_scores(df, [score_review_texts(df, mapping, sentiment_lib, splitter)], list(mapping.keys()))
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def bucket_trend_counters(fingerprint, freq, _counters):
+    """按周/月/季度汇总计数器；返回连续的周期轴，以及每条 (ASIN, 维度) 序列在汇总表中的行号。"""
+    counters = _counters
+    periods = counters["日期"].dt.to_period(freq)
+    full_range = pd.period_range(periods.min(), periods.max(), freq=freq)
+    table = (counters.assign(周期=periods)
+             .groupby(["ASIN", "维度", "周期"])[NSS_COUNT_COLS].sum().reset_index())
+    table["位置"] = pd.PeriodIndex(table["周期"]).asi8 - full_range.asi8[0]
+    return {"table": table, "range": full_range, "index": table.groupby(["ASIN", "维度"]).indices}
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def trend_series_cumsum(fingerprint, freq, asin, dimension, _bucketed):
+    # 稠密化到完整周期轴（无提及的周期补 0），再做一次累计和；之后任意窗口都是 O(周期数)
+    bucketed = _bucketed
+    dense = np.zeros((len(bucketed["range"]), len(NSS_COUNT_COLS)), dtype=np.int64)
+    positions = bucketed["index"].get((asin, dimension))
+    if positions is not None:
+        rows = bucketed["table"].iloc[positions]
+        dense[rows["位置"].to_numpy()] = rows[NSS_COUNT_COLS].to_numpy()
+    return np.vstack([np.zeros((1, len(NSS_COUNT_COLS)), dtype=np.int64), dense.cumsum(axis=0)])
+
+def rolling_nss_from_cumsum(cumsum, period_range, window):
+    end = np.arange(1, len(cumsum))
+    counts = cumsum[end] - cumsum[np.maximum(end - window, 0)]
+    hits, pos, neg = counts.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nss = np.where(hits > 0, (pos - neg) / hits, np.nan)
+    return pd.DataFrame({
+        "周期": period_range.astype(str),
+        "提及句子数": hits, "正面次数": pos, "负面次数": neg,
+        "NSS分数": np.round(nss, 3),
+    })
+
+def rolling_nss_series(fingerprint, freq, asin, dimension, window, bucketed):
+    cumsum = trend_series_cumsum(fingerprint, freq, asin, dimension, bucketed)
+    return rolling_nss_from_cumsum(cumsum, bucketed["range"], window)
+
+def monthly_trend_table(counters):
+    # 导出用：按月汇总的 ASIN × 维度 计数器与 NSS
+    table = (counters.assign(月份=pd.to_datetime(counters["日期"]).dt.to_period("M").astype(str))
+             .groupby(["ASIN", "月份", "维度"])[NSS_COUNT_COLS].sum().reset_index())
+    table["NSS分数"] = ((table["正面次数"] - table["负面次数"]) / table["提及句子数"]).round(3)
+    return table
+
+# --- 2.10 NSS 异动扫描 ---
+# 直接从最细粒度计数器的编码（日期→周期序号、ASIN、维度）用 np.add.at 铺成 ASIN × 维度 × 周期 的稠密张量，
+# 只保留最近 N+1 期，不经过趋势图用的逐序列分桶；一次性对所有序列计算“本期 vs 前 N 期”的变化显著性。
+# 单句情感得分取 -1/0/1，NSS 即其均值；用两组合并后的方差做双样本 z 检验，提及量小的序列波动再大也不会排到前面。
+ANOMALY_MAX_BASELINE = 6
+ANOMALY_TOP_K = 50
+
+def nss_change_zscores(current, baseline):
+    # current / baseline: (..., 3) 计数数组，最后一维依次为 提及/正面/负面
+    n1, pos1, neg1 = np.moveaxis(current.astype(np.float64), -1, 0)
+    n0, pos0, neg0 = np.moveaxis(baseline.astype(np.float64), -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nss1 = (pos1 - neg1) / n1
+        nss0 = (pos0 - neg0) / n0
+        p_pos = (pos1 + pos0) / (n1 + n0)
+        p_neg = (neg1 + neg0) / (n1 + n0)
+        variance = p_pos + p_neg - (p_pos - p_neg) ** 2
+        z = (nss1 - nss0) / np.sqrt(variance * (1 / n1 + 1 / n0))
+    return nss1, nss0, z
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def scan_nss_anomalies(fingerprint, freq, baseline_periods, min_mentions, _counters):
+    """
+    返回全部有效序列按 z 分数排序的异动表（负数为下跌）以及周期信息：
+    本期/基线期标签、总周期数 periods、扫描的序列数 series。
+    """
+    counters = _counters
+    # 日期只有几百~几千个不同取值：先对唯一日期换算周期序号，再按编码展开到每行（缺失日期编码为 -1，排除）
+    date_codes, dates = pd.factorize(counters["日期"])
+    dated = date_codes >= 0
+    ordinals = pd.DatetimeIndex(dates).to_period(freq).asi8[date_codes]
+    first, last = ordinals[dated].min(), ordinals[dated].max()
+    span = int(min(baseline_periods + 1, last - first + 1))
+    start = last - span + 1
+    recent = dated & (ordinals >= start)
+
+    # 先筛出近期行再编码，避免把整列字符串转成 numpy
+    asin_codes, asins = pd.factorize(counters["ASIN"][recent])
+    dim_codes, dims = pd.factorize(counters["维度"][recent])
+    asins, dims = np.asarray(asins, dtype=object), np.asarray(dims, dtype=object)
+    tensor = np.zeros((len(asins), len(dims), span, len(NSS_COUNT_COLS)), dtype=np.int32)
+    # 按天的计数器同一周期有多行，需要累加而不是赋值
+    np.add.at(tensor, (asin_codes, dim_codes, ordinals[recent] - start),
+              counters[NSS_COUNT_COLS].to_numpy()[recent].astype(np.int32))
+
+    current, baseline = tensor[:, :, -1], tensor[:, :, :-1].sum(axis=2)
+    nss1, nss0, z = nss_change_zscores(current, baseline)
+    valid = (current[..., 0] >= min_mentions) & (baseline[..., 0] >= min_mentions) & np.isfinite(z)
+    a_idx, d_idx = np.nonzero(valid)
+    order = np.argsort(z[a_idx, d_idx], kind="stable")
+    a_idx, d_idx = a_idx[order], d_idx[order]
+
+    movers = pd.DataFrame({
+        "ASIN": asins[a_idx],
+        "维度": dims[d_idx],
+        "本期NSS": nss1[a_idx, d_idx].round(3),
+        "基线NSS": nss0[a_idx, d_idx].round(3),
+        "变化": (nss1 - nss0)[a_idx, d_idx].round(3),
+        "本期提及": current[a_idx, d_idx, 0],
+        "基线提及": baseline[a_idx, d_idx, 0],
+        "z分数": z[a_idx, d_idx].round(2),
+    })
+    period = lambda ordinal: str(pd.Period(ordinal=int(ordinal), freq=freq))
+    labels = {"current": period(last),
+              "baseline": f"{period(start)} ~ {period(last - 1)}" if span > 1 else "-",
+              "periods": int(last - first + 1),
+              "series": int((tensor[..., 0].sum(axis=2) > 0).sum())}
+    return movers, labels
+
+# --- 2.11 引擎一致性校验 ---
+# ANALYSIS_ENGINES["reference"] 指向的 calculate_nss_logic / calculate_nss_monthly_trend /
+# calculate_age_distribution / perform_analysis 是口径基准，性能优化一律另写引擎，不改这几个函数。
+# 新引擎上线前，用下面的校验在合成数据和实际上传的数据上逐单元格对比，全部在容差内才能设为默认。
+PARITY_ATOL = 1e-9
+PARITY_SYNTHETIC_ROWS = 2000
+PARITY_SPLIT_SAMPLE = 5000
+PARITY_FILLERS = ["i bought these last week", "honestly", "overall", "the packaging was fine",
+                  "shipping took a while", "my friend recommended them", "not sure about the price",
+                  "mr. lee at the store said so", "e.g. the blue one"]
+PARITY_TERMINATORS = [".", "!", "?", "...", "!!", " 😍", '."']
+
+def make_synthetic_reviews(n_rows=PARITY_SYNTHETIC_ROWS, n_asins=30, seed=0):
+    """生成覆盖词库各分支的合成评论：维度词、正负面短语、否定词、年龄词、跨 ASIN 的重复文本、大小写与首尾空白差异、空评论。"""
+    rng = np.random.default_rng(seed)
+    dimensions = list(EXTENDED_MAPPING.keys())
+    phrases = [w for lib in SENTIMENT_LIB.values() if isinstance(lib, dict) for w in lib["正面"] + lib["负面"]]
+    age_words = [w for words in AGE_DEMOGRAPHICS_LIB.values() for w in words]
+    negations = ["not", "never", "don't", "no"]
+
+    def sentence():
+        parts = [PARITY_FILLERS[rng.integers(len(PARITY_FILLERS))], dimensions[rng.integers(len(dimensions))]]
+        if rng.random() < 0.6:
+            parts.append(phrases[rng.integers(len(phrases))])
+        if rng.random() < 0.15:
+            parts.insert(1, negations[rng.integers(len(negations))])
+        if rng.random() < 0.2:
+            parts.append(f"for my {age_words[rng.integers(len(age_words))]}")
+        return " ".join(parts) + PARITY_TERMINATORS[rng.integers(len(PARITY_TERMINATORS))]
+
+    reviews = []
+    for _ in range(n_rows):
+        roll = rng.random()
+        if reviews and roll < 0.25:
+            text = reviews[rng.integers(len(reviews))]
+            if isinstance(text, str) and rng.random() < 0.5:
+                text = f"  {text.upper()} "
+        elif roll < 0.27:
+            text = None
+        else:
+            text = " ".join(sentence() for _ in range(rng.integers(1, 5)))
+            if rng.random() < 0.3:
+                text = text.capitalize()
+        reviews.append(text)
+
+    asins = [f"SYN{i:05d}" for i in range(n_asins)]
+    titles = {a: " ".join(["alcohol markers"] + list(rng.choice(dimensions, rng.integers(2, 7), replace=False)))
+              for a in asins}
+    asin_col = [asins[i] for i in rng.integers(n_asins, size=n_rows)]
+    return pd.DataFrame({
+        "ASIN": asin_col,
+        "Title": [titles[a] for a in asin_col],
+        "Review Content": reviews,
+        "Month": [f"2024-{m:02d}" for m in rng.integers(1, 13, size=n_rows)],
+    })
+
+def compare_frames(reference, candidate, keys, atol=PARITY_ATOL):
+    """按主键逐单元格对比两张结果表（不比较行顺序），返回 (差异明细, 汇总)。"""
+    ref = reference.astype({k: str for k in keys})
+    cand = candidate.astype({k: str for k in keys})
+    value_cols = [c for c in ref.columns if c not in keys and c in cand.columns]
+    merged = ref.merge(cand, on=keys, how="outer", suffixes=("@参考", "@引擎"), indicator=True)
+    both = merged[merged["_merge"] == "both"]
+
+    details, max_diff = [], 0.0
+    for col in value_cols:
+        a, b = both[f"{col}@参考"], both[f"{col}@引擎"]
+        same_missing = a.isna() & b.isna()
+        if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+            diff = (b.astype(float) - a.astype(float)).abs()
+            bad = ~(diff <= atol) & ~same_missing
+            if diff.notna().any():
+                max_diff = max(max_diff, float(diff.max()))
+        else:
+            diff = pd.Series(np.nan, index=a.index)
+            bad = (a.astype(str) != b.astype(str)) & ~same_missing
+        if bad.any():
+            details.append(both.loc[bad, keys].assign(列=col, 参考值=a[bad].astype(str),
+                                                      引擎值=b[bad].astype(str), 差值=diff[bad]))
+
+    only_ref = merged[merged["_merge"] == "left_only"]
+    only_cand = merged[merged["_merge"] == "right_only"]
+    for rows, label in [(only_ref, "(引擎缺少此行)"), (only_cand, "(引擎多出此行)")]:
+        if len(rows):
+            details.append(rows[keys].assign(列=label, 参考值="", 引擎值="", 差值=np.nan))
+
+    missing_cols = sorted(set(reference.columns) ^ set(candidate.columns))
+    for col in missing_cols:
+        details.append(pd.DataFrame([{**{k: "" for k in keys}, "列": f"(列 {col} 仅存在于一侧)",
+                                      "参考值": "", "引擎值": "", "差值": np.nan}]))
+
+    detail_df = (pd.concat(details, ignore_index=True) if details
+                 else pd.DataFrame(columns=keys + ["列", "参考值", "引擎值", "差值"]))
+    bad_cells = len(detail_df) - len(only_ref) - len(only_cand) - len(missing_cols)
+    summary = {
+        "参考行数": len(reference),
+        "引擎行数": len(candidate),
+        "缺少行": len(only_ref),
+        "多出行": len(only_cand),
+        "对比单元格": len(both) * len(value_cols),
+        "超差单元格": bad_cells,
+        "最大绝对差": round(max_diff, 6),
+        "结论": "✅ 一致" if detail_df.empty else "❌ 不一致",
+    }
+    return detail_df, summary
+
+def parity_checks(df):
+    # (对比项, 计算函数, 主键)；计算函数接收某个引擎的函数表
+    checks = [
+        ("卖点匹配 (exact)", lambda f: f["marketing"](df.copy(), "exact"), ["关键词/卖点"]),
+        ("语义匹配 (fuzzy)", lambda f: f["marketing"](df.copy(), "fuzzy"), ["关键词/卖点"]),
+        ("维度 NSS", lambda f: f["nss"](df, PRECISE_MAPPING, SENTIMENT_LIB), ["ASIN", "维度"]),
+        ("年龄画像", lambda f: f["age"](df, AGE_DEMOGRAPHICS_LIB), ["ASIN", "年龄段"]),
+    ]
+    if 'Month' in df.columns:
+        checks.append(("月度趋势", lambda f: f["trend"](df, PRECISE_MAPPING, SENTIMENT_LIB), ["ASIN", "月份", "维度"]))
+    return checks
+
+def run_parity_suite(datasets, engine, atol=PARITY_ATOL):
+    """datasets: {名称: df}。返回 (汇总表, {(数据集, 对比项): 差异明细})。"""
+    reference, candidate = ANALYSIS_ENGINES["reference"], ANALYSIS_ENGINES[engine]
+    rows, details = [], {}
+    for name, df in datasets.items():
+        checks = parity_checks(df)
+        for check, run, keys in checks:
+            detail, summary = compare_frames(run(reference), run(candidate), keys, atol)
+            rows.append({"数据集": name, "对比项": check, **summary})
+            details[(name, check)] = detail
+
+        # 看板的趋势图走按日期汇总的计数器（与引擎无关），同样要和月度趋势基准对齐
+        if 'Month' in df.columns and not has_day_level_dates(df):
+            expected = reference["trend"](df, PRECISE_MAPPING, SENTIMENT_LIB)
+            counters = calculate_nss_trend_counters(df, PRECISE_MAPPING, SENTIMENT_LIB, candidate["splitter"])
+            actual = monthly_trend_table(counters)[["ASIN", "月份", "维度", "NSS分数"]]
+            detail, summary = compare_frames(expected, actual, ["ASIN", "月份", "维度"], atol)
+            rows.append({"数据集": name, "对比项": "趋势计数器 (按月汇总)", **summary})
+            details[(name, "趋势计数器 (按月汇总)")] = detail
+    return pd.DataFrame(rows), details
+
+# --- 2.12 跨会话共享结果缓存 ---
+# 所有会话共用一份按数据集指纹索引的计算结果：同一份周报被多人打开只算一次，读取直接返回同一个对象（不复制，调用方只读）。
+# 内存按预算做 LRU 淘汰，被淘汰的 DataFrame 以 Parquet 写到磁盘，再次命中时读回内存；其它类型的结果淘汰后直接丢弃，需要时重算。
+# 会话和 API 只保存 SharedJob 句柄（缓存键 + 计算方式），不持有结果本身，淘汰后内存才能真正释放。
+CACHE_RAM_BUDGET_MB = int(os.environ.get("ANALYSIS_CACHE_RAM_MB", 1024))
+CACHE_DISK_BUDGET_MB = int(os.environ.get("ANALYSIS_CACHE_DISK_MB", 4096))
+CACHE_SPILL_DIR = os.environ.get("ANALYSIS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "alcoholreviews_cache"))
+# 每个进程在 CACHE_SPILL_DIR 下使用自己的子目录，正常退出时删除；异常退出留下的子目录超过该时长未更新即视为过期清理
+CACHE_SPILL_STALE_HOURS = 24
+# 词库变化后旧结果作废：缓存键带上词库版本
+LEXICON_VERSION = hashlib.md5(repr((EXTENDED_MAPPING, SENTIMENT_LIB, AGE_DEMOGRAPHICS_LIB)).encode()).hexdigest()[:8]
+
+def estimate_nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            # 对象数组只存指针，字符串本体在堆上；重复的 ASIN 等共享同一对象，按去重后的值计
+            return value.nbytes + sum(sys.getsizeof(v) for v in pd.unique(value.ravel()))
+        return value.nbytes
+    if isinstance(value, dict):
+        # 含 Counter 及 {短语: Counter} 这类嵌套结构，键和值都占内存
+        return sys.getsizeof(value) + sum(estimate_nbytes(k) + estimate_nbytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v) for v in value)
+    if isinstance(value, CountMinSketch):
+        return value.table.nbytes
+    if sparse.issparse(value):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return sys.getsizeof(value)
+
+class SharedResultCache:
+    """进程级结果缓存：内存 LRU + 磁盘 Parquet 溢出；进行中的任务也会被各会话共享。"""
+
+    def __init__(self, ram_budget_mb, disk_budget_mb, spill_dir):
+        self.ram_budget = ram_budget_mb << 20
+        self.disk_budget = disk_budget_mb << 20
+        os.makedirs(spill_dir, exist_ok=True)
+        self._remove_stale_spills(spill_dir)
+        # 多个进程（Streamlit / API / 分区任务）可能共用同一个溢出目录，各自只读写自己的子目录
+        self.spill_dir = tempfile.mkdtemp(prefix=f"run-{os.getpid()}-", dir=spill_dir)
+        atexit.register(shutil.rmtree, self.spill_dir, ignore_errors=True)
+        self._lock = threading.RLock()
+        self._memory = OrderedDict()   # key -> (value, nbytes)
+        self._disk = OrderedDict()     # key -> (path, nbytes)
+        self._pending = {}             # key -> Future
+        self._refs = Counter()         # 持有进行中任务的会话数
+        self.ram_used = self.disk_used = 0
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def _remove_stale_spills(spill_dir):
+        cutoff = time.time() - CACHE_SPILL_STALE_HOURS * 3600
+        for entry in os.scandir(spill_dir):
+            if entry.is_dir() and entry.name.startswith("run-") and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.md5(key.encode()).hexdigest() + ".parquet")
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._memory or key in self._disk
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key][0]
+            if key in self._disk:
+                path, size = self._disk[key]
+                if os.path.exists(path):
+                    self._disk.move_to_end(key)
+                    value = pd.read_parquet(path, memory_map=True)
+                    self.hits += 1
+                    self._store(key, value)
+                    return value
+                # 溢出文件已被外部清理（如临时目录回收），按未命中处理，由句柄重算
+                del self._disk[key]
+                self.disk_used -= size
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        if key in self._memory:
+            self.ram_used -= self._memory.pop(key)[1]
+        nbytes = estimate_nbytes(value)
+        self._memory[key] = (value, nbytes)
+        self.ram_used += nbytes
+        # 刚写入的结果始终留在内存：即使单个结果超出预算，也不会写入即被丢弃、再被句柄反复重算
+        while self.ram_used > self.ram_budget and len(self._memory) > 1:
+            old_key, (old_value, old_bytes) = self._memory.popitem(last=False)
+            self.ram_used -= old_bytes
+            self._spill(old_key, old_value)
+
+    def _spill(self, key, value):
+        if not isinstance(value, pd.DataFrame) or key in self._disk:
+            return
+        path = self._spill_path(key)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        value.to_parquet(path)
+        size = os.path.getsize(path)
+        self._disk[key] = (path, size)
+        self.disk_used += size
+        while self.disk_used > self.disk_budget and self._disk:
+            _, (old_path, old_size) = self._disk.popitem(last=False)
+            self.disk_used -= old_size
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def submit(self, key, executor, fn, *args):
+        """已缓存返回 None；同一 key 正在计算时复用同一个 Future；否则提交到线程池，完成后写入缓存。"""
+        with self._lock:
+            if key in self._pending:
+                self._refs[key] += 1
+                return self._pending[key]
+            if key in self:
+                return None
+            future = executor.submit(fn, *args)
+            self._pending[key] = future
+            self._refs[key] += 1
+        future.add_done_callback(lambda f: self._finish(key, f))
+        return future
+
+    def _finish(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+                del self._refs[key]
+            if not future.cancelled() and future.exception() is None:
+                self._store(key, future.result())
+
+    def release(self, key):
+        # 会话不再需要某个结果：没有其它会话等待时才取消尚未开始的任务
+        with self._lock:
+            if key not in self._pending:
+                return
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                self._pending[key].cancel()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._memory), "spilled": len(self._disk),
+                    "ram_mb": self.ram_used / (1 << 20), "disk_mb": self.disk_used / (1 << 20),
+                    "hits": self.hits, "misses": self.misses}
+
+class SharedJob:
+    """
+    会话侧的任务句柄，done()/result() 与 Future 用法相同。计算完成后只保留缓存键，结果每次从共享缓存读取；
+    结果被淘汰且没有落盘时，done() 会重新提交计算。
+    """
+
+    def __init__(self, cache, key, executor, fn, *args):
+        self.key = key
+        self._cache, self._executor, self._fn, self._args = cache, executor, fn, args
+        self._future = None
+        self._attach()
+
+    def _compute(self):
+        # 排队期间结果可能已由 result_inline() 就地算出，直接取用
+        value = self._cache.get(self.key)
+        return value if value is not None else self._fn(*self._args)
+
+    def _attach(self):
+        future = self._cache.submit(self.key, self._executor, self._compute)
+        self._future = future
+        if future is not None:
+            future.add_done_callback(self._detach)
+        return future
+
+    def _detach(self, future):
+        # 成功的结果已由共享缓存接管，句柄不再引用 Future；失败的保留下来，result() 时抛出异常
+        if self._future is future and not future.cancelled() and future.exception() is None:
+            self._future = None
+
+    def done(self):
+        if self._future is None and self.key not in self._cache:
+            self._attach()
+        future = self._future
+        return future is None or future.done()
+
+    def result(self, timeout=None):
+        future = self._future
+        if future is None:
+            value = self._cache.get(self.key)
+            if value is not None:
+                return value
+            future = self._attach()
+            if future is None:
+                return self.result(timeout)
+        return future.result(timeout)
+
+    def result_inline(self):
+        """
+        供线程池内的任务读取依赖结果：只等待已经在跑的计算，排队中、被取消或已被淘汰的结果在当前线程直接算出并写入缓存，
+        不会在池内等待排在自己后面的任务而把线程池占满。仅用于自身不再依赖其它任务的句柄（如评分分片）。
+        """
+        future = self._future
+        if future is not None and not future.cancelled() and (future.running() or future.done()):
+            return future.result()
+        value = self._cache.get(self.key)
+        if value is None:
+            value = self._fn(*self._args)
+            self._cache.put(self.key, value)
+        return value
+
+@st.cache_resource
+def get_shared_cache():
+    return SharedResultCache(CACHE_RAM_BUDGET_MB, CACHE_DISK_BUDGET_MB, CACHE_SPILL_DIR)
+
+# --- 2.13 卖点共现与情感联动 ---
+# 复用共享评分任务的文本计分表（不再单独评分），得到 评论 × 维度 的三张稀疏矩阵：是否提及 M、提及句子数 H、净情感句数 N（正面-负面）。
+# 某个 ASIN 分组内每条文本的出现次数记为 w，则一次稀疏乘积即可得到全部维度两两组合：
+#   共现评论数 C = Mᵀ·diag(w)·M，条件 NSS(A|B) = (Nᵀ·diag(w)·M)[A,B] / (Hᵀ·diag(w)·M)[A,B]
+COOCCURRENCE_MIN_SUPPORT = 5
+COOCCURRENCE_TOP_CATEGORIES = 30
+COOCCURRENCE_METRICS = ["共现评论数", "提升度 (Lift)", "条件 NSS 变化"]
+
+def build_mention_matrices(df, score_tables, categories):
+    text_ids, unique_texts, scores = attach_text_scores(df, score_tables)
+    rows = scores["text_id"].to_numpy()
+    cols = pd.Categorical(scores["维度"], categories=categories).codes
+    shape = (len(unique_texts), len(categories))
+
+    def matrix(values):
+        return sparse.csr_matrix((np.asarray(values, dtype=np.float64), (rows, cols)), shape=shape)
+
+    mentions = matrix(np.ones(len(scores)))
+    return {
+        "categories": categories,
+        "mentions": mentions,
+        # [M | H | N] 横向拼接，转置后与 diag(w)·M 做一次乘积即可同时得到三个 维度×维度 矩阵
+        "stacked": sparse.hstack([mentions, matrix(scores["提及句子数"]),
+                                  matrix(scores["正面次数"] - scores["负面次数"])]).tocsr(),
+        "asin": df['ASIN'].astype(str).to_numpy(),
+        "text_ids": text_ids,
+    }
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def compute_cooccurrence(fingerprint, asin, _matrices):
+    """返回 asin（"全部" 为全量）分组内的 共现评论数 / 提升度 / 条件 NSS 矩阵，行列为维度。"""
+    m = _matrices
+    text_ids = m["text_ids"] if asin == "全部" else m["text_ids"][m["asin"] == asin]
+    weights = np.bincount(text_ids[text_ids >= 0], minlength=m["mentions"].shape[0]).astype(np.float64)
+    total_reviews = len(text_ids)
+
+    mentions, stacked = m["mentions"], m["stacked"]
+    if asin != "全部":
+        # 单个 ASIN 只涉及少量文本，先按行裁剪再相乘
+        rows = np.flatnonzero(weights)
+        mentions, stacked, weights = mentions[rows], stacked[rows], weights[rows]
+    weighted = mentions.multiply(weights[:, None]).tocsr()
+    co, hits, net = np.split((stacked.T @ weighted).toarray(), 3)
+
+    support = np.diag(co)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lift = co * total_reviews / np.outer(support, support)
+        cond_nss = net / hits
+    base_nss = np.diag(cond_nss)
+
+    index = pd.Index(m["categories"], name="维度")
+    frame = lambda values: pd.DataFrame(values, index=index, columns=index)
+    return {
+        "共现评论数": frame(co),
+        "提升度 (Lift)": frame(lift),
+        "条件 NSS": frame(cond_nss),
+        "条件 NSS 变化": frame(cond_nss - base_nss[:, None]),
+        "support": pd.Series(support, index=index),
+        "total_reviews": total_reviews,
+    }
+
+def top_cooccurring_pairs(result, min_support=COOCCURRENCE_MIN_SUPPORT):
+    co = result["共现评论数"]
+    a_idx, b_idx = np.triu_indices(len(co), k=1)
+    support = co.to_numpy()[a_idx, b_idx]
+    keep = support >= min_support
+    a_idx, b_idx = a_idx[keep], b_idx[keep]
+    names = co.index.to_numpy()
+    nss = result["条件 NSS"].to_numpy()
+    pairs = pd.DataFrame({
+        "维度 A": names[a_idx],
+        "维度 B": names[b_idx],
+        "共现评论数": support[keep].astype(int),
+        "提升度 (Lift)": result["提升度 (Lift)"].to_numpy()[a_idx, b_idx].round(2),
+        "A 的 NSS": nss[a_idx, a_idx].round(3),
+        "同提 B 时 A 的 NSS": nss[a_idx, b_idx].round(3),
+        "B 的 NSS": nss[b_idx, b_idx].round(3),
+        "同提 A 时 B 的 NSS": nss[b_idx, a_idx].round(3),
+    })
+    return pairs.sort_values("提升度 (Lift)", ascending=False).reset_index(drop=True)
+
+# --- 2.14 本地 HTTP 分析服务 ---
+# 供其它内部工具直接取数，只监听 127.0.0.1。看板侧边栏可启动；也可以不开看板，直接 python alcoholreviews.py 离线运行。
+# 接口（均返回 JSON，结果表的列名与看板/导出一致）：
+#   GET  /health                                  存活检查
+#   GET  /metrics                                 各接口请求数与延迟分位数、评分批处理统计
+#   GET  /datasets                                常驻内存的数据集列表
+#   POST /datasets?name=xx.csv[&preview=200][&family_dedup=1]   请求体为原始 CSV/Excel 文件，返回 dataset_id
+#   GET  /datasets/<id>                           各项计算是否完成
+#   GET  /datasets/<id>/nss?asin=&category=&month=&freq=M      不带 month/freq 为 ASIN×维度 NSS，否则按周期汇总
+#   GET  /datasets/<id>/age?asin=                 年龄段占比
+#   GET  /datasets/<id>/marketing?mode=exact|fuzzy 标题卖点的评论回声率
+#   DELETE /datasets/<id>                         移出内存
+#   POST /score  {"texts": [...]}                 临时文本评分；并发请求在短窗口内合并成一次评分
+# 查询类接口默认最多等待计算 API_JOB_TIMEOUT 秒，可用 timeout= 参数调整，超时返回 504。
+API_PORT = int(os.environ.get("ANALYSIS_API_PORT", 8765))
+API_MAX_WARM_DATASETS = 8
+API_JOB_TIMEOUT = 120
+API_LATENCY_WINDOW = 1000
+SCORE_BATCH_WINDOW = 0.02      # 秒：收到第一个评分请求后再等这么久，把并发请求合成一批
+SCORE_BATCH_MAX_TEXTS = 5000
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class LatencyRecorder:
+    """按接口记录最近 API_LATENCY_WINDOW 次请求耗时。"""
+
+    def __init__(self, window=API_LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._counts, self._errors = Counter(), Counter()
+        self._window = window
+
+    def record(self, route, seconds, ok=True):
+        with self._lock:
+            self._durations.setdefault(route, deque(maxlen=self._window)).append(seconds * 1000)
+            self._counts[route] += 1
+            if not ok:
+                self._errors[route] += 1
+
+    def snapshot(self):
+        with self._lock:
+            rows = []
+            for route, durations in self._durations.items():
+                p50, p95, p99 = np.percentile(np.fromiter(durations, dtype=np.float64), [50, 95, 99])
+                rows.append({"接口": route, "请求数": self._counts[route], "错误数": self._errors[route],
+                             "p50_ms": round(p50, 2), "p95_ms": round(p95, 2), "p99_ms": round(p99, 2),
+                             "max_ms": round(max(durations), 2)})
+            return rows
+
+class ScoringBatcher:
+    """合并并发的临时评分请求：窗口内的文本去重后调用一次 score_unique_reviews_nss，再按请求拆回。"""
+
+    def __init__(self, mapping, sentiment_lib, splitter, window=SCORE_BATCH_WINDOW, max_texts=SCORE_BATCH_MAX_TEXTS):
+        self.mapping, self.sentiment_lib, self.splitter = mapping, sentiment_lib, splitter
+        self.window, self.max_texts = window, max_texts
+        self._queue = queue.Queue()
+        self.batches = self.texts = self.unique_texts = 0
+        threading.Thread(target=self._run, name="score-batcher", daemon=True).start()
+
+    def score(self, texts, timeout=API_JOB_TIMEOUT):
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future.result(timeout=timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.window
+            while size < self.max_texts:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+            try:
+                self._score_batch(batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _score_batch(self, batch):
+        all_texts = pd.Series([t for texts, _ in batch for t in texts], dtype=object)
+        text_ids, unique_texts = pd.factorize(normalize_review_text(all_texts))
+        scores = score_unique_reviews_nss(unique_texts, self.mapping, self.sentiment_lib, self.splitter)
+        self.batches += 1
+        self.texts += len(all_texts)
+        self.unique_texts += len(unique_texts)
+
+        offset = 0
+        for texts, future in batch:
+            ids = text_ids[offset:offset + len(texts)]
+            offset += len(texts)
+            rows = pd.DataFrame({"text_index": np.arange(len(texts)), "text_id": ids}).merge(scores, on="text_id")
+            summary = rows.groupby("维度", sort=False)[NSS_COUNT_COLS].sum().reset_index()
+            summary["NSS分数"] = nss_score_column(summary)
+            future.set_result({"per_text": rows.drop(columns="text_id"), "summary": summary})
+
+    def stats(self):
+        return {"batches": self.batches, "texts": self.texts, "unique_texts": self.unique_texts,
+                "mean_batch_texts": round(self.texts / self.batches, 1) if self.batches else 0}
+
+class AnalysisService:
+    """API 后端：数据集常驻内存（LRU），计算复用看板的后台任务与共享缓存。"""
+
+    def __init__(self, engine=None, max_datasets=API_MAX_WARM_DATASETS):
+        self.engine = engine or DEFAULT_ENGINE
+        self.max_datasets = max_datasets
+        self._lock = threading.Lock()
+        self._datasets = OrderedDict()   # dataset_id -> {"name", "df", "jobs"}
+        self.metrics = LatencyRecorder()
+        self.batcher = ScoringBatcher(PRECISE_MAPPING, SENTIMENT_LIB, ANALYSIS_ENGINES[self.engine]["splitter"])
+
+    def register(self, name, df, dataset_id, preview_size=None, family_dedup=False):
+        job_key = analysis_fingerprint(dataset_id, preview_size, family_dedup, self.engine)
+        with self._lock:
+            if dataset_id in self._datasets and self._datasets[dataset_id]["jobs"]["fingerprint"] == job_key:
+                self._datasets.move_to_end(dataset_id)
+            else:
+                self._evict(dataset_id)
+                jobs = build_analysis_jobs(df, job_key, preview_size, family_dedup, self.engine)
+                self._datasets[dataset_id] = {"name": name, "df": df, "jobs": jobs}
+            while len(self._datasets) > self.max_datasets:
+                self._evict(next(iter(self._datasets)))
+        return self.describe(dataset_id)
+
+    def upload(self, name, body, preview_size=None, family_dedup=False):
+        if not name.endswith(('.csv', '.xlsx')):
+            raise ApiError(400, "name 参数需以 .csv 或 .xlsx 结尾")
+        dataset_id = get_dataset_fingerprint(body)
+        try:
+            df = load_uploaded_file(name, dataset_id, body)
+        except Exception as e:
+            raise ApiError(400, f"文件解析失败: {e}")
+        missing = {'ASIN', 'Title', 'Review Content'} - set(df.columns)
+        if missing:
+            raise ApiError(400, f"缺少列: {sorted(missing)}")
+        return self.register(name, df, dataset_id, preview_size, family_dedup)
+
+    def _evict(self, dataset_id):
+        entry = self._datasets.pop(dataset_id, None)
+        if entry is not None:
+            cache = get_shared_cache()
+            for key in entry["jobs"]["cache_keys"]:
+                cache.release(key)
+
+    def remove(self, dataset_id):
+        with self._lock:
+            self._get(dataset_id)
+            self._evict(dataset_id)
+
+    def _get(self, dataset_id):
+        if dataset_id not in self._datasets:
+            raise ApiError(404, f"未找到数据集 {dataset_id}")
+        self._datasets.move_to_end(dataset_id)
+        return self._datasets[dataset_id]
+
+    def describe(self, dataset_id):
+        with self._lock:
+            entry = self._get(dataset_id)
+        jobs = entry["jobs"]
+        status = {name: jobs[name].done() for name in ("exact", "fuzzy", "age", "trend", "phrases", "cooccurrence")
+                  if jobs[name] is not None}
+        status["nss"] = all(f.done() for f in jobs["nss_shards"])
+        return {"dataset_id": dataset_id, "name": entry["name"], "rows": len(entry["df"]),
+                "asins": len(jobs["asins"]), "analysis": jobs["fingerprint"], "done": status}
+
+    def list(self):
+        with self._lock:
+            ids = list(self._datasets)
+        return [self.describe(i) for i in ids]
+
+    def _results(self, dataset_id, futures, timeout):
+        with self._lock:
+            entry = self._get(dataset_id)
+        deadline = time.monotonic() + timeout
+        try:
+            return entry, [f.result(timeout=max(deadline - time.monotonic(), 0)) for f in futures(entry["jobs"])]
+        except FutureTimeoutError:
+            raise ApiError(504, "计算尚未完成，请稍后重试或增大 timeout")
+
+    def nss(self, dataset_id, asin=None, category=None, month=None, freq=None, timeout=API_JOB_TIMEOUT):
+        if month or freq:
+            # 参数先校验，不合法的请求不必等待趋势任务算完
+            freq = freq or "M"
+            if freq not in TREND_FREQS.values():
+                raise ApiError(400, f"freq 需为 {list(TREND_FREQS.values())} 之一")
+            if not self._has_trend(dataset_id):
+                raise ApiError(400, "数据集没有 Month 或日期列，无法按周期查询")
+            _, (counters,) = self._results(dataset_id, lambda j: [j["trend"]], timeout)
+            table = (counters.assign(周期=counters["日期"].dt.to_period(freq).astype(str))
+                     .groupby(["ASIN", "周期", "维度"])[NSS_COUNT_COLS].sum().reset_index())
+            table["NSS分数"] = nss_score_column(table)
+            if month:
+                table = table[table["周期"] == month]
+        else:
+            _, shards = self._results(dataset_id, lambda j: j["nss_shards"], timeout)
+            table = pd.concat(shards, ignore_index=True) if shards else pd.DataFrame(columns=["ASIN", "维度"])
+        if asin:
+            table = table[table["ASIN"] == asin]
+        if category:
+            table = table[table["维度"] == category]
+        return table
+
+    def _has_trend(self, dataset_id):
+        with self._lock:
+            return self._get(dataset_id)["jobs"]["trend"] is not None
+
+    def age(self, dataset_id, asin=None, timeout=API_JOB_TIMEOUT):
+        _, (table,) = self._results(dataset_id, lambda j: [j["age"]], timeout)
+        return table[table["ASIN"] == asin] if asin and not table.empty else table
+
+    def marketing(self, dataset_id, mode="exact", timeout=API_JOB_TIMEOUT):
+        if mode not in ("exact", "fuzzy"):
+            raise ApiError(400, "mode 需为 exact 或 fuzzy")
+        _, (table,) = self._results(dataset_id, lambda j: [j[mode]], timeout)
+        return table
+
+def frame_to_records(df):
+    # to_json 会把 NaN 转成 null、时间转成 ISO 字符串
+    return json.loads(df.to_json(orient="records", force_ascii=False, date_format="iso"))
+
+def number_param(params, name, cast, default=None, minimum=0):
+    # 查询参数转数字；格式不对或超出范围是调用方的错，返回 400 而不是 500
+    if not params.get(name):
+        return default
+    try:
+        value = cast(params[name])
+    except ValueError:
+        raise ApiError(400, f"参数 {name} 需为数字")
+    if not value > minimum:
+        raise ApiError(400, f"参数 {name} 需大于 {minimum}")
+    return value
+
+def make_api_handler(service):
+    class AnalysisApiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            # 出错前没读走的请求体还留在连接里，长连接上的下一个请求会被错位解析：直接关闭连接
+            if self._body_bytes is None and self.headers.get("Content-Length", "0") != "0":
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            if self._body_bytes is None:
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                except ValueError:
+                    raise ApiError(400, "Content-Length 无效")
+                self._body_bytes = self.rfile.read(length)
+            return self._body_bytes
+
+        def _dispatch(self, method):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            parts = [p for p in url.path.split("/") if p]
+            timeout = number_param(params, "timeout", float, API_JOB_TIMEOUT)
+
+            if method == "GET" and parts == ["health"]:
+                return {"status": "ok"}
+            if method == "GET" and parts == ["metrics"]:
+                return {"latency": service.metrics.snapshot(), "score_batches": service.batcher.stats()}
+            if method == "POST" and parts == ["score"]:
+                try:
+                    payload = json.loads(self._body() or b"{}")
+                except ValueError:
+                    raise ApiError(400, "请求体需为 JSON")
+                if not isinstance(payload, dict):
+                    raise ApiError(400, "请求体需为 JSON 对象")
+                texts = payload.get("texts")
+                if not isinstance(texts, list):
+                    raise ApiError(400, "请求体需包含 texts 列表")
+                try:
+                    result = service.batcher.score([str(t) for t in texts], timeout)
+                except FutureTimeoutError:
+                    raise ApiError(504, "评分超时")
+                return {"per_text": frame_to_records(result["per_text"]),
+                        "summary": frame_to_records(result["summary"])}
+            if parts[:1] == ["datasets"]:
+                if len(parts) == 1 and method == "GET":
+                    return {"datasets": service.list()}
+                if len(parts) == 1 and method == "POST":
+                    preview = number_param(params, "preview", int)
+                    return service.upload(params.get("name", "upload.csv"), self._body(), preview,
+                                          params.get("family_dedup") == "1")
+                dataset_id = parts[1] if len(parts) > 1 else None
+                if len(parts) == 2 and method == "GET":
+                    return service.describe(dataset_id)
+                if len(parts) == 2 and method == "DELETE":
+                    service.remove(dataset_id)
+                    return {"removed": dataset_id}
+                if len(parts) == 3 and method == "GET":
+                    if parts[2] == "nss":
+                        table = service.nss(dataset_id, params.get("asin"), params.get("category"),
+                                            params.get("month"), params.get("freq"), timeout)
+                    elif parts[2] == "age":
+                        table = service.age(dataset_id, params.get("asin"), timeout)
+                    elif parts[2] == "marketing":
+                        table = service.marketing(dataset_id, params.get("mode", "exact"), timeout)
+                    else:
+                        raise ApiError(404, f"未知接口 {url.path}")
+                    return {"dataset_id": dataset_id, "rows": frame_to_records(table)}
+            raise ApiError(404, f"未知接口 {method} {url.path}")
+
+        def _handle(self, method):
+            start, ok = time.perf_counter(), True
+            self._body_bytes = None
+            # 延迟按接口模板统计：/datasets/<id>/nss 而不是每个数据集一条
+            parts = [p for p in urlparse(self.path).path.split("/") if p]
+            route = "/" + "/".join(parts[:1] + ["<id>"] * (len(parts) > 1) + parts[2:3])
+            try:
+                self._send(200, self._dispatch(method))
+            except ApiError as e:
+                ok = e.status < 500
+                self._send(e.status, {"error": str(e)})
+            except Exception as e:
+                ok = False
+                self._send(500, {"error": f"{type(e).__name__}: {e}"})
+            finally:
+                service.metrics.record(f"{method} {route}", time.perf_counter() - start, ok)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_DELETE(self):
+            self._handle("DELETE")
+
+    return AnalysisApiHandler
+
+def start_analysis_service(port=API_PORT, engine=None):
+    service = AnalysisService(engine)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_api_handler(service))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="analysis-api", daemon=True)
+    thread.start()
+    service.server, service.thread = server, thread
+    return service
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_service(port):
+    return start_analysis_service(port)
+
+# --- 2.15 分区执行与部分结果合并 ---
+# 超大全量数据按 ASIN 哈希切成 N 个分区，各分区可在任意机器/进程上独立计算，产出只含可加计数器的部分结果文件；
+# 合并时按键求和再统一算 NSS / 占比 / 回声率，结果与单机 dedup 引擎一致，合并耗时只与 ASIN×维度×月份 等单元格数有关。
+# 分区文件先写临时文件再原子改名，重跑时已完成且口径一致的分区直接跳过，因此中断后可以续跑。
+PARTITION_READ_CHUNK_ROWS = 500_000
+PARTITION_FILE_PATTERN = "part-{index:05d}-of-{parts:05d}.partial.zip"
+PARTITION_COLUMNS = ['ASIN', 'Title', 'Review Content', 'Month'] + DATE_COLUMNS
+WORD_TOKEN_PATTERN = re.compile(r"\w+")
+INPUT_FINGERPRINT_BLOCK = 1 << 20   # 输入指纹按 1 MiB 分块流式哈希整个文件，内存占用与文件大小无关
+
+def asin_partition(asins, parts):
+    # crc32 与进程无关（内置 hash 每个进程加盐不同），各节点对同一 ASIN 的分区结论一致
+    codes, uniques = pd.factorize(asins.astype(str))
+    buckets = np.fromiter((zlib.crc32(a.encode("utf-8")) % parts for a in uniques), dtype=np.int64, count=len(uniques))
+    return buckets[codes]
+
+def describe_inputs(paths):
+    # 输入指纹：文件名 + 大小 + 全文内容哈希。只哈希首尾会漏掉中间等长的改动，导致跳过本该重算的分区；
+    # 不用修改时间，同一份导出拷到不同节点后 mtime 往往不同
+    stats = []
+    for path in paths:
+        size = os.path.getsize(path)
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(INPUT_FINGERPRINT_BLOCK), b""):
+                digest.update(block)
+        stats.append((os.path.basename(path), size, digest.hexdigest()))
+    return hashlib.md5(repr(sorted(stats)).encode()).hexdigest()
+
+def read_partition_rows(paths, parts, index):
+    """只把属于第 index 个分区的行读进内存；CSV 分块读取。"""
+    frames = []
+    for path in sorted(paths):
+        if path.endswith(".csv"):
+            chunks = pd.read_csv(path, chunksize=PARTITION_READ_CHUNK_ROWS,
+                                 usecols=lambda c: c in PARTITION_COLUMNS)
+        elif path.endswith(".parquet"):
+            chunks = [pd.read_parquet(path)]
+        else:
+            chunks = [pd.read_excel(path)]
+        for chunk in chunks:
+            chunk = chunk[[c for c in PARTITION_COLUMNS if c in chunk.columns]]
+            frames.append(chunk[asin_partition(chunk['ASIN'], parts) == index])
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['ASIN', 'Title', 'Review Content'])
+
+def marketing_partial(df):
+    """标题卖点的可加计数：每个关键词的 标题ASIN数 / 关联评论总数 / 评论提及次数（口径同 perform_analysis）。"""
+    df = df[df['ASIN'].notna()]
+    titles = df['Title'].fillna('').astype(str).str.lower()
+    reviews = df['Review Content'].fillna('').astype(str).str.lower()
+    asin_titles = titles.groupby(df['ASIN']).first()
+    asin_codes = pd.Index(asin_titles.index).get_indexer(df['ASIN'])
+    text_ids, unique_texts = pd.factorize(reviews)
+    # ASIN × 唯一文本 的出现次数矩阵
+    copies = sparse.csr_matrix((np.ones(len(df)), (asin_codes, text_ids)), shape=(len(asin_titles), len(unique_texts)))
+    reviews_per_asin = np.asarray(copies.sum(axis=1)).ravel()
+    rows = []
+
+    # exact：关键词与评论都是 \w 组成的整词，\bkw\b 命中等价于评论的整词集合里包含 kw，可以一次稀疏乘积算完
+    kw_lists = asin_titles.apply(get_title_keywords)
+    vocab = pd.Index(sorted({w for ws in kw_lists for w in ws}))
+    if len(vocab):
+        vocab_set = set(vocab)
+        title_tokens = [set(WORD_TOKEN_PATTERN.findall(t)) & vocab_set for t in asin_titles]
+        title_hits = sparse.csr_matrix(
+            (np.ones(sum(map(len, title_tokens))),
+             ([i for i, ws in enumerate(title_tokens) for _ in ws], vocab.get_indexer([w for ws in title_tokens for w in ws]))),
+            shape=(len(asin_titles), len(vocab)))
+        text_words = [vocab.get_indexer(list(set(WORD_TOKEN_PATTERN.findall(t)) & vocab_set)) for t in unique_texts]
+        text_hits = sparse.csr_matrix(
+            (np.ones(sum(map(len, text_words))),
+             (np.repeat(np.arange(len(unique_texts)), [len(w) for w in text_words]),
+              np.concatenate(text_words) if text_words else np.array([], dtype=np.int64))),
+            shape=(len(unique_texts), len(vocab)))
+        mentions_per_asin = (copies @ text_hits).multiply(title_hits)
+        word_counts = Counter(w for ws in kw_lists for w in ws)
+        rows.append(pd.DataFrame({
+            "模式": "exact",
+            "关键词/卖点": vocab,
+            "标题词频": [word_counts[w] for w in vocab],
+            "标题ASIN数": np.asarray(title_hits.sum(axis=0)).ravel().astype(np.int64),
+            "关联评论总数": (title_hits.T @ reviews_per_asin).astype(np.int64),
+            "评论提及次数": np.asarray(mentions_per_asin.sum(axis=0)).ravel().astype(np.int64),
+        }))
+
+    # fuzzy：同义词可能是多词短语，按正则逐个卖点在相关 ASIN 的唯一文本上匹配
+    fuzzy = []
+    for key_word, synonyms in CLEAN_MAPPING.items():
+        relevant = asin_titles.str.contains(fr'\b{re.escape(key_word)}\b', na=False).to_numpy()
+        if not relevant.any():
+            continue
+        per_text = np.asarray(copies[relevant].sum(axis=0)).ravel()
+        ids = np.flatnonzero(per_text)
+        pattern = r'\b(?:' + '|'.join(re.escape(w) for w in synonyms) + r')\b'
+        hits = pd.Series(unique_texts[ids]).str.contains(pattern, na=False).to_numpy()
+        fuzzy.append(("fuzzy", key_word, 0, int(relevant.sum()), int(reviews_per_asin[relevant].sum()),
+                      int(per_text[ids][hits].sum())))
+    rows.append(pd.DataFrame(fuzzy, columns=["模式", "关键词/卖点", "标题词频", "标题ASIN数", "关联评论总数", "评论提及次数"]))
+    return pd.concat(rows, ignore_index=True)
+
+def compute_partition_partial(df, splitter="punkt"):
+    """单个分区的部分结果：全部是可加计数器，不含比率。"""
+    text_ids, unique_texts = pd.factorize(normalize_review_text(df['Review Content']))
+    categories = list(PRECISE_MAPPING.keys())
+    scores = score_unique_reviews_nss(unique_texts, PRECISE_MAPPING, SENTIMENT_LIB, splitter)
+    nss = pd.DataFrame(columns=["ASIN", "维度"] + NSS_COUNT_COLS)
+    trend = pd.DataFrame(columns=["ASIN", "日期", "维度"] + NSS_COUNT_COLS)
+    if not scores.empty:
+        nss = aggregate_nss_counters(df[['ASIN']], text_ids, scores, ['ASIN'], categories)
+        if has_trend_dates(df):
+            # 日期口径与看板趋势计数器相同（resolve_review_dates），按月预汇总，合并后交给 monthly_trend_table
+            months = resolve_review_dates(df).dt.to_period("M").dt.to_timestamp()
+            keys = pd.DataFrame({"ASIN": df['ASIN'], "日期": months})
+            trend = aggregate_nss_counters(keys, text_ids, scores, ['ASIN', '日期'], categories)
+
+    age = calculate_age_distribution_dedup(df, AGE_DEMOGRAPHICS_LIB)
+    if age.empty:
+        age = pd.DataFrame(columns=["ASIN", "年龄段", "提及评论数", "识别评论数"])
+    return {
+        "nss": nss,
+        "trend": trend,
+        "age": age[["ASIN", "年龄段", "提及评论数"]],
+        "age_totals": age[["ASIN", "识别评论数"]].drop_duplicates("ASIN"),
+        "marketing": marketing_partial(df),
+        "asins": pd.DataFrame({"ASIN": pd.Series(df['ASIN'].dropna().unique(), dtype=object)}),
+    }
+
+def run_partition(paths, parts, index, out_dir, splitter=None):
+    """计算并写出第 index 个分区；目标文件已存在且口径一致时跳过。返回 (文件路径, 是否新计算)。"""
+    splitter = splitter or ANALYSIS_ENGINES[DEFAULT_ENGINE]["splitter"]
+    meta = {"inputs": describe_inputs(paths), "parts": parts, "index": index,
+            "lexicon": LEXICON_VERSION, "splitter": splitter}
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, PARTITION_FILE_PATTERN.format(index=index, parts=parts))
+    if os.path.exists(path):
+        done = read_partial_meta(path)
+        if all(done.get(k) == v for k, v in meta.items()):
+            return path, False
+
+    df = read_partition_rows(paths, parts, index)
+    meta.update(has_dates=has_trend_dates(df), rows=len(df))
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    write_parquet_bundle(compute_partition_partial(df, splitter), tmp_path)
+    with zipfile.ZipFile(tmp_path, "a") as bundle:
+        bundle.writestr("meta.json", json.dumps(meta))
+    os.replace(tmp_path, path)
+    return path, True
+
+def read_partial_meta(path):
+    with zipfile.ZipFile(path) as bundle:
+        return json.loads(bundle.read("meta.json"))
+
+def read_partial(path):
+    with zipfile.ZipFile(path) as bundle:
+        tables = {name[:-len(".parquet")]: pd.read_parquet(io.BytesIO(bundle.read(name)))
+                  for name in bundle.namelist() if name.endswith(".parquet")}
+        return json.loads(bundle.read("meta.json")), tables
+
+def marketing_table_from_counters(counters, total_asins, mode):
+    # 与 perform_analysis 相同的比率与取整口径
+    records = []
+    for key_word, title_mentions, total_reviews, review_mentions in zip(
+            counters["关键词/卖点"], counters["标题ASIN数"], counters["关联评论总数"], counters["评论提及次数"]):
+        title_penetration = (title_mentions / total_asins) * 100
+        echo_rate = (review_mentions / total_reviews * 100) if total_reviews > 0 else 0
+        conversion = echo_rate / title_penetration if title_penetration > 0 else 0
+        records.append({
+            "关键词/卖点": key_word,
+            "语义涵盖范围": "-" if mode == "exact" else ", ".join(CLEAN_MAPPING[key_word][:3]) + "...",
+            "标题ASIN数": title_mentions,
+            "标题渗透率 (%)": round(title_penetration, 2),
+            "关联评论总数": total_reviews,
+            "评论提及次数": review_mentions,
+            "评论回声率 (%)": round(echo_rate, 2),
+            "心智转化比": round(conversion, 2),
+        })
+    return pd.DataFrame(records).sort_values("评论回声率 (%)", ascending=False)
+
+def merge_partials(paths):
+    """合并全部分区文件，返回与看板导出同名的结果表。缺分区、口径不一致时报错。"""
+    if not paths:
+        raise ValueError("没有可合并的分区文件")
+    metas, parts_tables = zip(*(read_partial(p) for p in paths))
+    signature = {(m["inputs"], m["parts"], m["lexicon"], m["splitter"]) for m in metas}
+    if len(signature) > 1:
+        raise ValueError(f"分区文件来自不同的输入或口径：{sorted(signature)}")
+    parts = metas[0]["parts"]
+    indexes = Counter(m["index"] for m in metas)
+    missing = sorted(set(range(parts)) - set(indexes))
+    duplicated = sorted(i for i, n in indexes.items() if n > 1)
+    if missing or duplicated:
+        raise ValueError(f"分区不完整：缺少 {missing}，重复 {duplicated}")
+
+    def combined(name):
+        return pd.concat([t[name] for t in parts_tables], ignore_index=True)
+
+    categories = list(PRECISE_MAPPING.keys())
+    def merge_counters(frame, keys):
+        frame = frame.assign(维度=pd.Categorical(frame["维度"], categories=categories))
+        agg = frame.groupby(keys + ["维度"], observed=True)[NSS_COUNT_COLS].sum().reset_index()
+        agg["维度"] = agg["维度"].astype(str)
+        agg["NSS分数"] = nss_score_column(agg)
+        return agg
+
+    nss = merge_counters(combined("nss"), ["ASIN"])
+    # 月度趋势与看板导出同一个函数生成：列、月份标签、NSS 取整口径都一致
+    trend = monthly_trend_table(combined("trend")) if any(m["has_dates"] for m in metas) else pd.DataFrame()
+
+    age_labels = list(AGE_DEMOGRAPHICS_LIB.keys())
+    totals = combined("age_totals").groupby("ASIN")["识别评论数"].sum()
+    age_counts = combined("age").groupby(["ASIN", "年龄段"])["提及评论数"].sum()
+    grid = pd.MultiIndex.from_product([totals.index, age_labels], names=["ASIN", "年龄段"])
+    age = age_counts.reindex(grid, fill_value=0).rename("提及评论数").reset_index()
+    age["识别评论数"] = age["ASIN"].map(totals)
+    age["占比 (%)"] = [round(c / t * 100, 1) for c, t in zip(age["提及评论数"], age["识别评论数"])]
+
+    total_asins = combined("asins")["ASIN"].nunique()
+    marketing = combined("marketing").groupby(["模式", "关键词/卖点"], sort=False).sum().reset_index()
+    exact = marketing[marketing["模式"] == "exact"]
+    # 与 Counter.most_common(100) 一致按标题词频取前 100；同频次按字母序，保证各次合并结果稳定
+    exact = exact.sort_values(["标题词频", "关键词/卖点"], ascending=[False, True], kind="stable").head(100)
+    # fuzzy 按 CLEAN_MAPPING 的顺序排列（即 perform_analysis 的遍历顺序）
+    fuzzy = marketing[marketing["模式"] == "fuzzy"].set_index("关键词/卖点")
+    fuzzy = fuzzy.reindex([k for k in CLEAN_MAPPING if k in fuzzy.index]).reset_index()
+
+    age_tables = age if not totals.empty else pd.DataFrame()
+    return {
+        "词频精确匹配": marketing_table_from_counters(exact, total_asins, "exact"),
+        "语义模糊匹配": marketing_table_from_counters(fuzzy, total_asins, "fuzzy"),
+        "ASIN维度NSS": nss,
+        "月度趋势": trend,
+        "年龄分布": age_tables,
+        "Top10儿童占比": build_top10_child_table(age_tables) if not age_tables.empty else pd.DataFrame(),
+    }
+
 # --- 3. 展示层 ---
+def render_paged_table(df, cache_key, gradients, key, page_size=TABLE_PAGE_SIZE):
+    """
+    代替 st.dataframe(df.style.background_gradient(...))：
+    颜色整表只算一次，筛选/排序/翻页在服务端完成，只给当前页套样式下发到浏览器。
+    """
+    df = df.reset_index(drop=True)
+    colors = compute_table_colors(cache_key, tuple(gradients.items()), df)
+
+    c1, c2, c3, c4 = st.columns([3, 2, 1, 1])
+    with c1:
+        query = st.text_input("🔍 筛选", key=f"{key}_filter", placeholder="输入关键词，匹配任意文本列")
+    with c2:
+        sort_col = st.selectbox("排序列", ["(默认)"] + list(df.columns), key=f"{key}_sort")
+    with c3:
+        ascending = st.toggle("升序", key=f"{key}_asc")
+    view = filter_and_sort_table(df, query, None if sort_col == "(默认)" else sort_col, ascending)
+
+    n_pages = max(1, -(-len(view) // page_size))
+    page_key = f"{key}_page"
+    if st.session_state.get(page_key, 1) > n_pages:
+        st.session_state[page_key] = n_pages
+    with c4:
+        page = st.number_input("页码", min_value=1, max_value=n_pages, value=1, key=page_key)
+
+    page_df = view.iloc[(page - 1) * page_size: page * page_size]
+    styler = page_df.style
+    for col, css in colors.items():
+        styler = styler.apply(lambda s, css=css: css[s.index.to_numpy()], subset=[col])
+    st.dataframe(styler, use_container_width=True)
+    st.caption(f"共 {len(view)} 行 · 第 {page}/{n_pages} 页")
+
+def render_marketing_section(jobs, polling):
+    tab1, tab2 = st.tabs(["🔍 词频精确匹配", "🧬 语义模糊匹配"])
+
+    with tab1:
+        st.markdown("🔍 **逻辑：** 自动提取标题高频词，匹配评论原文。")
+        if jobs["exact"].done():
+            res_exact = jobs["exact"].result()
+            render_paged_table(res_exact, (jobs["fingerprint"], "exact"),
+                               {'评论回声率 (%)': ('YlGnBu', None, None), '心智转化比': ('YlGnBu', None, None)},
+                               key="table_exact")
+        else:
+            st.info("⏳ 正在后台计算词频精确匹配...")
+
+    with tab2:
+        st.markdown("🧬 **逻辑：** 基于同义词词库进行模糊匹配渗透。")
+        if jobs["fuzzy"].done():
+            res_fuzzy = jobs["fuzzy"].result()
+            render_paged_table(res_fuzzy, (jobs["fingerprint"], "fuzzy"),
+                               {'评论回声率 (%)': ('OrRd', None, None), '心智转化比': ('OrRd', None, None)},
+                               key="table_fuzzy")
+        else:
+            st.info("⏳ 正在后台计算语义模糊匹配...")
+
+    if jobs["exact"].done() and jobs["fuzzy"].done():
+        finish_polling(polling)
+
+def render_nss_section(jobs, polling):
+    shards = jobs["nss_shards"]
+    nss_results, done_count = collect_nss_results(jobs)
+
+    if done_count < len(shards):
+        st.progress(done_count / len(shards),
+                    text=f"正在计算 ASIN 级分维度情感... 已完成 {done_count}/{len(shards)} 个分片")
+    else:
+        finish_polling(polling)
+
+    if nss_results.empty:
+        if done_count == len(shards):
+            st.warning("未能匹配到词库中的卖点，请扩充映射表。")
+        return
+
+    # --- 3.1 概览看板 ---
+    all_asins = ["全部"] + sorted(nss_results['ASIN'].unique().tolist())
+    selected_asin = st.selectbox("🎯 选择要深入查看的 ASIN：", all_asins, key="nss_asin_selector")
+
+    display_df, plot_title, fig_spec = build_nss_view(jobs["fingerprint"], done_count, selected_asin,
+                                                      bool(jobs["preview"]), nss_results)
+    st.subheader(f"📊 {plot_title}")
+    st.plotly_chart(fig_spec, use_container_width=True)
+
+    # --- 3.2 数据明细表 ---
+    st.subheader("📋 维度明细数据对照表")
+    if "样本不足" in display_df.columns and display_df["样本不足"].any():
+        st.warning(f"⚠️ 有 {int(display_df['样本不足'].sum())} 个维度在样本中提及句子数不足 {PREVIEW_MIN_CELL}，置信区间较宽，请以完整计算为准。")
+    render_paged_table(display_df, (jobs["fingerprint"], "nss", done_count, selected_asin),
+                       {'NSS分数': ('RdYlGn', -1, 1)}, key="table_nss")
+
+def render_trend_section(jobs, polling):
+    # --- 3.3 口碑趋势波动看板 ---
+    st.subheader("📈 维度口碑趋势波动看板")
+
+    if jobs["trend"] is None:
+        st.error("❌ 数据表中未发现 'Month' 或日期列，无法生成时间趋势图。")
+        return
+    if not jobs["trend"].done():
+        st.info("⏳ 正在追溯月度趋势...")
+        return
+    finish_polling(polling)
+
+    counters = jobs["trend"].result()
+    if jobs["undated_rows"]:
+        st.warning(f"⚠️ 有 {jobs['undated_rows']} 条评论的日期/月份为空或无法识别，未计入趋势。")
+    if counters.empty:
+        st.warning("未能根据数据生成月份趋势。")
+        return
+
+    # 周粒度需要精确到天的日期列；只有 Month 列时提供月/季度
+    freq_options = list(TREND_FREQS) if jobs["day_level_dates"] else ["月", "季度"]
+    c0, c3 = st.columns(2)
+    with c0:
+        freq_label = st.radio("时间粒度", freq_options, index=freq_options.index("月"), horizontal=True, key="trend_freq")
+    with c3:
+        window = st.slider("滚动窗口（期数，1 为不滚动）", 1, TREND_MAX_WINDOW, 1, key="trend_window")
+    bucketed = bucket_trend_counters(jobs["fingerprint"], TREND_FREQS[freq_label], counters)
+
+    # 自动关联上方的 ASIN 选择，如果是“全部”则允许在此单独选一个看趋势
+    trend_asins = sorted({asin for asin, _ in bucketed["index"]})
+    selected_asin = st.session_state.get("nss_asin_selector", "全部")
+    view_mode = st.radio("视图", ["单维度趋势", "全部维度小多图"], horizontal=True, key="trend_view_mode")
+    c1, c2 = st.columns(2)
+    with c1:
+        trend_asin = st.selectbox("1. 趋势分析-确认 ASIN", trend_asins,
+                                  index=trend_asins.index(selected_asin) if selected_asin in trend_asins else 0,
+                                  key="trend_asin_unique")
+
+    if view_mode == "全部维度小多图":
+        st.plotly_chart(build_trend_small_multiples_spec(jobs["fingerprint"], trend_asin, freq_label, window, bucketed),
+                        use_container_width=True)
+        return
+
+    with c2:
+        valid_dims = sorted(dim for asin, dim in bucketed["index"] if asin == trend_asin)
+        chosen_dim = st.selectbox("2. 趋势分析-选择维度", valid_dims, key="trend_dim_unique")
+
+    fig_spec = build_trend_line_spec(jobs["fingerprint"], trend_asin, chosen_dim, freq_label, window, bucketed)
+    if fig_spec is not None:
+        st.plotly_chart(fig_spec, use_container_width=True)
+    else:
+        st.warning("所选维度暂无月度统计数据。")
+
+def render_anomaly_section(jobs, polling):
+    # --- 3.4 NSS 异动扫描 ---
+    if jobs["trend"] is None:
+        return
+    st.subheader("🚨 口碑异动榜 (Biggest Movers)")
+    if not jobs["trend"].done():
+        st.info("⏳ 正在等待趋势计数器...")
+        return
+    finish_polling(polling)
+
+    counters = jobs["trend"].result()
+    if counters.empty:
+        st.warning("未能根据数据生成月份趋势。")
+        return
+
+    freq_options = list(TREND_FREQS) if jobs["day_level_dates"] else ["月", "季度"]
+    c1, c2, c3, c4 = st.columns(4)
+    with c1:
+        freq_label = st.radio("时间粒度", freq_options, index=freq_options.index("月"), horizontal=True, key="anomaly_freq")
+    with c2:
+        baseline_periods = st.slider("基线期数（本期之前）", 1, ANOMALY_MAX_BASELINE, 3, key="anomaly_baseline")
+    with c3:
+        min_mentions = st.number_input("最少提及句子数", min_value=1, value=5, step=1, key="anomaly_min_mentions")
+    with c4:
+        direction = st.radio("方向", ["下跌", "上涨", "全部"], horizontal=True, key="anomaly_direction")
+
+    movers, labels = scan_nss_anomalies(jobs["fingerprint"], TREND_FREQS[freq_label],
+                                        baseline_periods, int(min_mentions), counters)
+    if labels["periods"] < 2:
+        st.warning("周期数不足，无法对比。")
+        return
+
+    if direction == "下跌":
+        movers = movers[movers["z分数"] < 0]
+    elif direction == "上涨":
+        movers = movers[movers["z分数"] > 0].iloc[::-1]
+    else:
+        movers = movers.iloc[movers["z分数"].abs().to_numpy().argsort(kind="stable")[::-1]]
+
+    st.caption(f"本期：{labels['current']}；基线：{labels['baseline']}。z 分数为 NSS 变化量除以其标准误，"
+               f"|z| > 3 基本可以排除偶然波动。共扫描 {labels['series']} 条近期有提及的 ASIN × 维度序列。")
+    st.dataframe(movers.head(ANOMALY_TOP_K), height=400, use_container_width=True, hide_index=True)
+
+def render_age_section(jobs, polling):
+    if not jobs["age"].done():
+        st.info("⏳ 正在提取年龄特征...")
+        return
+    finish_polling(polling)
+
+    age_results = jobs["age"].result()
+    if age_results.empty:
+        st.warning("当前评论数据中未发现明显的年龄标签词。")
+        return
+
+    # 独立的下拉框，使用唯一的 key
+    age_asins = ["全部"] + sorted(age_results['ASIN'].unique().tolist())
+    age_selected_asin = st.selectbox("🎯 选择要查看年龄画像的 ASIN：", age_asins, key="age_selector_unique")
+
+    display_age, fig_spec = build_age_view(jobs["fingerprint"], age_selected_asin, bool(jobs["preview"]), age_results)
+    if display_age.empty:
+        st.warning(f"ASIN: {age_selected_asin} 暂无明显的年龄相关特征数据。")
+        return
+
+    c1, c2 = st.columns([3, 2])
+    with c1:
+        st.plotly_chart(fig_spec, use_container_width=True)
+        st.caption(AGE_SHARE_NOTE)
+    with c2:
+        st.markdown("### 🎯 核心受众判定")
+        # 自动获取占比最高的年龄段
+        top_age = display_age.sort_values("提及评论数", ascending=False).iloc[0]
+        st.metric("核心受众群", top_age['年龄段'])
+        st.write(f"在识别到身份标签的评论中，约有 **{top_age['占比 (%)']}%** 的用户指向 **{top_age['年龄段']}**。")
+
+        # 商业建议小贴士
+        if "儿童" in top_age['年龄段']:
+            st.warning("📍 **运营建议**：建议在 Listing 中强调『无毒』、『易清洗』及『耐摔性』，视觉上增加家庭/亲子元素。")
+        elif "成年人" in top_age['年龄段']:
+            st.success("📍 **运营建议**：建议强调『色彩过渡』、『叠色效果』及『笔触细腻度』，视觉上走专业/艺术风格。")
+
+    if jobs["preview"] and display_age["样本不足"].any():
+        st.warning(f"⚠️ 样本中识别到身份标签的评论不足 {PREVIEW_MIN_CELL} 条，占比仅供参考。")
+
+def render_top10_child_section(jobs, polling):
+    if not jobs["age"].done():
+        st.info("⏳ 等待年龄画像分析完成...")
+        return
+    finish_polling(polling)
+
+    age_results = jobs["age"].result()
+    if age_results.empty:
+        st.warning("请先运行年龄画像分析板块")
+        return
+
+    child_data = build_top10_child_table(age_results)
+
+    if not child_data.empty:
+        # 简单表格展示
+        st.dataframe(child_data)
+
+        # 简单图表
+        fig = px.bar(child_data, x='ASIN', y='占比 (%)',
+                     title='Top10 ASIN儿童使用占比',
+                     text='占比 (%)')
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.warning("没有找到儿童占比数据")
+
+def render_export_panel(jobs, dataset_name):
+    st.sidebar.divider()
+    st.sidebar.subheader("📦 导出报告")
+    if not report_jobs_done(jobs):
+        st.sidebar.caption("全部分析完成后可导出。")
+        return
+
+    export_format = st.sidebar.radio("格式", list(EXPORT_FORMATS), key="export_format")
+    export = st.session_state.get("export_file")
+    if st.sidebar.button("生成报告", key="export_build"):
+        if export is not None and os.path.exists(export["path"]):
+            os.remove(export["path"])
+        with st.spinner("正在写出报告..."):
+            path = export_report(jobs, export_format)
+        export = {"fingerprint": jobs["fingerprint"], "format": export_format, "path": path}
+        st.session_state["export_file"] = export
+
+    if export is not None and export["fingerprint"] == jobs["fingerprint"] and export["format"] == export_format:
+        suffix, _, mime = EXPORT_FORMATS[export_format]
+        with open(export["path"], "rb") as fh:
+            st.sidebar.download_button("⬇️ 下载报告", fh, file_name=f"{os.path.splitext(dataset_name)[0]}_report{suffix}",
+                                       mime=mime, key="export_download")
+
+def render_api_panel(dataset_name, df, dataset_id):
+    with st.sidebar.expander("🔌 本地 API 服务"):
+        if not st.toggle("启动本地 API", key="api_enabled"):
+            st.caption(f"启动后在 http://127.0.0.1:{API_PORT} 提供 NSS / 年龄 / 卖点查询接口，供其它工具直接取数。")
+            return
+        try:
+            service = get_analysis_service(API_PORT)
+        except OSError as e:
+            st.error(f"端口 {API_PORT} 启动失败：{e}")
+            return
+        st.caption(f"✅ 运行中：http://127.0.0.1:{API_PORT}")
+        if st.button("📤 发布当前数据集", key="api_publish"):
+            info = service.register(dataset_name, df, dataset_id)
+            st.code(f"dataset_id = {info['dataset_id']}")
+        metrics = service.metrics.snapshot()
+        if metrics:
+            st.dataframe(pd.DataFrame(metrics), hide_index=True, use_container_width=True)
+
+def render_phrase_gap_section(jobs, polling):
+    if not jobs["phrases"].done():
+        st.info("⏳ 正在流式扫描评论短语...")
+        return
+    finish_polling(polling)
+
+    gaps = jobs["phrases"].result()
+    if gaps["top"].empty:
+        st.success("未发现词库之外的高频短语。")
+        return
+
+    c1, c2 = st.columns([3, 2])
+    with c1:
+        st.subheader("🌐 全量未覆盖高频短语")
+        st.caption(f"计数为 Count-Min Sketch 估计值，可能偏高，偏高幅度不超过约 {gaps['error_bound']} 次。")
+        st.dataframe(gaps["top"], height=400, use_container_width=True)
+    with c2:
+        st.subheader("🎯 按 ASIN 查看")
+        gap_asin = st.selectbox("选择 ASIN：", jobs["asins"], key="phrase_gap_asin")
+        st.caption("按 ASIN 的次数为精确计数；“可能漏计”大于 0 的短语在扫描中途才进入候选集，次数偏低。")
+        st.dataframe(phrase_gaps_for_asin(gaps, gap_asin), height=400, use_container_width=True)
+
+def render_parity_section(datasets, engine):
+    if not PUNKT_AVAILABLE:
+        st.warning("未找到 NLTK punkt 数据包，基准函数无法运行。请联网后重启，或手动执行 nltk.download('punkt_tab')。")
+        return
+    candidates = [e for e in ANALYSIS_ENGINES if e != "reference"]
+    c1, c2, c3, c4 = st.columns(4)
+    with c1:
+        candidate = st.selectbox("待校验引擎", candidates,
+                                 index=candidates.index(engine) if engine in candidates else 0, key="parity_engine")
+    with c2:
+        synthetic_rows = st.number_input("合成评论条数", min_value=100, max_value=50000,
+                                         value=PARITY_SYNTHETIC_ROWS, step=500, key="parity_rows")
+    with c3:
+        seed = st.number_input("随机种子", min_value=0, value=0, step=1, key="parity_seed")
+    with c4:
+        atol = st.number_input("数值容差", min_value=0.0, value=PARITY_ATOL, format="%.1e", key="parity_atol")
+
+    if st.button("🧪 运行一致性校验", key="parity_run"):
+        suites = {"合成数据": make_synthetic_reviews(int(synthetic_rows), seed=int(seed))}
+        suites.update({name: df for name, (df, _) in datasets.items()})
+        with st.spinner("正在用基准函数与待校验引擎分别计算..."):
+            summary, details = run_parity_suite(suites, candidate, atol)
+            splitter = ANALYSIS_ENGINES[candidate]["splitter"]
+            split_report = ({name: compare_sentence_splitters(
+                                df['Review Content'].dropna().astype(str).str.lower().head(PARITY_SPLIT_SAMPLE), splitter)
+                             for name, df in suites.items()}
+                            if splitter != "punkt" else None)
+            st.session_state["parity_report"] = (candidate, summary, details, split_report)
+
+    if "parity_report" not in st.session_state:
+        return
+    checked_engine, summary, details, split_report = st.session_state["parity_report"]
+    failed = summary[summary["结论"] != "✅ 一致"]
+    if failed.empty:
+        st.success(f"引擎 {checked_engine} 在全部 {len(summary)} 个对比项上与基准一致。")
+    else:
+        st.error(f"引擎 {checked_engine} 有 {len(failed)} 个对比项与基准不一致。")
+    st.dataframe(summary, use_container_width=True, hide_index=True)
+    if not failed.empty:
+        pick = st.selectbox("查看差异明细", [f"{r.数据集} / {r.对比项}" for r in failed.itertuples()], key="parity_detail")
+        name, check = pick.split(" / ", 1)
+        st.dataframe(details[(name, check)], height=300, use_container_width=True, hide_index=True)
+
+    if split_report:
+        splitter = ANALYSIS_ENGINES[checked_engine]["splitter"]
+        st.subheader(f"✂️ 分句对比：{splitter} vs punkt")
+        st.caption(f"每个数据集取前 {PARITY_SPLIT_SAMPLE} 条评论（小写后）逐条对比断句位置。")
+        st.dataframe(pd.DataFrame([{"数据集": name, "一致率 (%)": round(agreement * 100, 2), "不一致条数": len(diff)}
+                                   for name, (agreement, diff) in split_report.items()]),
+                     use_container_width=True, hide_index=True)
+        split_name = st.selectbox("查看断句差异", list(split_report), key="parity_split_detail")
+        st.dataframe(split_report[split_name][1], height=300, use_container_width=True, hide_index=True)
+
+def render_cooccurrence_section(jobs, polling):
+    if not jobs["cooccurrence"].done():
+        st.info("⏳ 正在构建评论 × 维度提及矩阵...")
+        return
+    finish_polling(polling)
+
+    matrices = jobs["cooccurrence"].result()
+    c1, c2, c3, c4 = st.columns(4)
+    with c1:
+        co_asin = st.selectbox("ASIN 范围", ["全部"] + jobs["asins"], key="cooccurrence_asin")
+    with c2:
+        metric = st.radio("热力图指标", COOCCURRENCE_METRICS, key="cooccurrence_metric")
+    with c3:
+        top_n = st.slider("展示提及最多的维度数", 5, len(matrices["categories"]),
+                          min(COOCCURRENCE_TOP_CATEGORIES, len(matrices["categories"])), key="cooccurrence_top_n")
+    with c4:
+        min_support = st.number_input("最少共现评论数", min_value=1, value=COOCCURRENCE_MIN_SUPPORT, step=1,
+                                      key="cooccurrence_min_support")
+
+    result = compute_cooccurrence(jobs["fingerprint"], co_asin, matrices)
+    support = result["support"]
+    top_dims = support[support > 0].nlargest(top_n).index
+    if len(top_dims) < 2:
+        st.warning("该范围内被提及的维度不足两个。")
+        return
+
+    co = result["共现评论数"].loc[top_dims, top_dims]
+    values = result[metric].loc[top_dims, top_dims].where(co >= min_support)
+    if metric == "条件 NSS 变化":
+        # 行 A、列 B：同时提到 B 的评论里，A 的 NSS 比 A 的整体 NSS 高/低多少
+        fig = px.imshow(values, color_continuous_scale="RdYlGn", color_continuous_midpoint=0, zmin=-1, zmax=1,
+                        labels=dict(x="同时提及", y="维度", color="ΔNSS"), aspect="auto")
+    elif metric == "提升度 (Lift)":
+        fig = px.imshow(np.log2(values), color_continuous_scale="RdBu_r", color_continuous_midpoint=0,
+                        labels=dict(x="维度", y="维度", color="log2 Lift"), aspect="auto")
+    else:
+        fig = px.imshow(values, color_continuous_scale="Blues", labels=dict(x="维度", y="维度", color="评论数"),
+                        aspect="auto")
+    fig.update_layout(height=max(450, 18 * len(top_dims)), template="plotly_white")
+    st.plotly_chart(fig, use_container_width=True)
+    st.caption(f"共 {result['total_reviews']} 条评论；共现评论数低于 {min_support} 的格子留空。")
+
+    st.subheader("🔗 强关联卖点组合")
+    st.dataframe(top_cooccurring_pairs(result, min_support).head(100), height=400,
+                 use_container_width=True, hide_index=True)
+
+def render_comparison_section(all_jobs, polling):
+    futures = [f for jobs in all_jobs.values() for f in [jobs["fuzzy"], jobs["age"], *jobs["nss_shards"]]]
+    done_count = sum(f.done() for f in futures)
+    if done_count < len(futures):
+        st.progress(done_count / len(futures), text=f"等待所有数据集完成计算... {done_count}/{len(futures)}")
+        return
+    finish_polling(polling)
+
+    names = list(all_jobs)
+    baseline = st.selectbox("📌 选择基准数据集", names, key="compare_baseline")
+    tab_nss, tab_age, tab_echo = st.tabs(["🎭 维度 NSS 对比", "👥 年龄占比对比", "🧬 卖点回声率对比"])
+
+    with tab_nss:
+        frames = {}
+        for name, jobs in all_jobs.items():
+            nss_results, _ = collect_nss_results(jobs)
+            if not nss_results.empty:
+                frames[name] = summarize_nss_by_dimension(nss_results)
+        if baseline not in frames:
+            st.warning("基准数据集没有匹配到任何维度。")
+        else:
+            table = build_comparison_table(frames, "维度", "NSS分数", baseline)
+            delta_cols = [c for c in table.columns if c.startswith("Δ ")]
+            # 默认展示差异最大的 10 个维度
+            top_dims = table.assign(_gap=table[delta_cols].abs().max(axis=1)).nlargest(10, "_gap")["维度"].tolist() if delta_cols else []
+            chosen_dims = st.multiselect("选择对比维度", table["维度"].tolist(), default=top_dims, key="compare_dims")
+            if chosen_dims:
+                long_df = table[table["维度"].isin(chosen_dims)].melt(id_vars="维度", value_vars=list(frames),
+                                                                       var_name="数据集", value_name="NSS分数")
+                fig = px.bar(long_df, x="维度", y="NSS分数", color="数据集", barmode="group",
+                             range_y=[-1, 1], template="plotly_white")
+                st.plotly_chart(fig, use_container_width=True)
+            st.dataframe(table, height=400, use_container_width=True)
+
+    with tab_age:
+        frames = {name: summarize_age_shares(jobs["age"].result())
+                  for name, jobs in all_jobs.items() if not jobs["age"].result().empty}
+        if baseline not in frames:
+            st.warning("基准数据集中未发现年龄标签词。")
+        else:
+            table = build_comparison_table(frames, "年龄段", "占比 (%)", baseline)
+            long_df = table.melt(id_vars="年龄段", value_vars=list(frames), var_name="数据集", value_name="占比 (%)")
+            fig = px.bar(long_df, x="占比 (%)", y="年龄段", color="数据集", orientation='h', barmode="group")
+            st.plotly_chart(fig, use_container_width=True)
+            st.caption(AGE_SHARE_NOTE)
+            st.dataframe(table, use_container_width=True)
+
+    with tab_echo:
+        frames = {name: jobs["fuzzy"].result() for name, jobs in all_jobs.items()}
+        table = build_comparison_table(frames, "关键词/卖点", "评论回声率 (%)", baseline)
+        st.dataframe(table, height=400, use_container_width=True)
+
 st.title("🎯 酒精笔评论分析看板")
 
-# 整个脚本只保留一个 file_uploader
-uploaded_file = st.file_uploader("上传数据文件 (Excel/CSV)", type=['csv', 'xlsx'])
+# 整个脚本只保留一个 file_uploader，可一次上传多个站点/竞品集的文件
+uploaded_files = st.file_uploader("上传数据文件 (Excel/CSV，可多选)", type=['csv', 'xlsx'], accept_multiple_files=True)
 
-if uploaded_file:
+if uploaded_files:
     try:
-        # 1. 数据读取逻辑
-        if uploaded_file.name.endswith('.csv'):
-            df_input = pd.read_csv(uploaded_file)
-        else:
-            df_input = pd.read_excel(uploaded_file)
+        # 1. 数据读取逻辑：多文件并发解析，读完立即把全部分析提交到后台
+        datasets = load_datasets(uploaded_files)
+        dataset_names = list(datasets)
+        active_name = (st.sidebar.selectbox("📂 当前查看的数据集", dataset_names, key="active_dataset")
+                       if len(dataset_names) > 1 else dataset_names[0])
+
+        # 快速预览：按 ASIN（趋势按 ASIN×月份）分层抽样，先看大致结论再决定是否跑完整计算
+        preview_mode = st.sidebar.toggle("⚡ 快速预览模式 (分层抽样)", key="preview_mode")
+        preview_size = st.sidebar.number_input("每个 ASIN / 月份抽样评论数", min_value=20, max_value=5000,
+                                               value=PREVIEW_DEFAULT_SIZE, step=50, disabled=not preview_mode)
+        # 同一父体下变体 ASIN 共享的评论：默认按文本去重后只评分一次（结果不变），可选按家族只计一次
+        family_dedup = st.sidebar.checkbox("🧬 同一父体的重复评论只计一次", key="family_dedup",
+                                           help="有 'Parent ASIN' 列时按父体分组，否则把共享过同一条较长评论文本的 ASIN 视为同一家族。")
+        # 计算引擎开关：reference 为原始逐句实现，其余引擎需先通过页面底部的一致性校验
+        engine = st.sidebar.selectbox("⚙️ 计算引擎", AVAILABLE_ENGINES, index=AVAILABLE_ENGINES.index(DEFAULT_ENGINE),
+                                      key="analysis_engine",
+                                      help="dedup-regex 使用正则分句，速度更快、不依赖 NLTK 数据包，但断句口径与 punkt 不完全一致。")
+        all_jobs = {name: submit_analysis_jobs(df, fingerprint, preview_size=int(preview_size) if preview_mode else None,
+                                               family_dedup=family_dedup, engine=engine)
+                    for name, (df, fingerprint) in datasets.items()}
+        prune_analysis_jobs(all_jobs.values())
+        df_input, jobs = datasets[active_name][0], all_jobs[active_name]
 
         # 基础数据统计
         total_a = df_input['ASIN'].nunique()
         total_r = len(df_input)
         st.sidebar.metric("分析 ASIN 总数", total_a)
         st.sidebar.metric("分析评论总条数", total_r)
+        st.sidebar.metric("唯一评论文本数", count_unique_reviews(datasets[active_name][1], df_input))
+        cache_stats = get_shared_cache().stats()
+        st.sidebar.caption(f"🗄️ 共享缓存：内存 {cache_stats['ram_mb']:.0f}/{CACHE_RAM_BUDGET_MB} MB，"
+                           f"磁盘 {cache_stats['disk_mb']:.0f} MB，命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']}")
+        render_export_panel(jobs, active_name)
+        render_api_panel(active_name, df_input, datasets[active_name][1])
+
+        if jobs["preview"]:
+            st.warning(f"⚡ 当前为抽样预览：情感与年龄板块基于 {jobs['preview']['rows']} 条抽样评论，"
+                       f"数值附带 95% 置信区间。")
+            st.button("🎯 运行完整精确计算", on_click=lambda: st.session_state.update(preview_mode=False))
 
         # 2. 词频匹配板块 (Tab 模式)
         st.header("📈 营销心智转化分析 (Marketing Consistency)")
         st.info("💡 **说明**：此板块分析“文案一致性”。只有当 ASIN 的**标题**提到了该关键词，我们才去统计其评论回声。")
-        
-        tab1, tab2 = st.tabs(["🔍 词频精确匹配", "🧬 语义模糊匹配"])
-
-        with tab1:
-            st.markdown("🔍 **逻辑：** 自动提取标题高频词，匹配评论原文。")
-            res_exact = perform_analysis(df_input, mode="exact")
-            st.dataframe(res_exact.style.background_gradient(subset=['评论回声率 (%)', '心智转化比'], cmap='YlGnBu'), use_container_width=True)
-
-        with tab2:
-            st.markdown("🧬 **逻辑：** 基于同义词词库进行模糊匹配渗透。")
-            res_fuzzy = perform_analysis(df_input, mode="fuzzy")
-            st.dataframe(res_fuzzy.style.background_gradient(subset=['评论回声率 (%)', '心智转化比'], cmap='OrRd'), use_container_width=True)
+        render_progressive(render_marketing_section, [jobs["exact"], jobs["fuzzy"]], jobs)
 
         # 3. 情感分析板块
         st.divider()
         st.header("🎭 全量原声口碑诊断 (Overall Voice of Customer)")
         st.info("💡 **说明**：此板块分析“用户真实关注点”。直接扫描**全量评论**，无论标题是否提及。用于发现那些标题没写、但用户极其在意的隐含痛点。")
-  
-        with st.spinner('正在计算 ASIN 级分维度情感...'):
-            PRECISE_MAPPING = {k: [k] for k in EXTENDED_MAPPING.keys()}
-            nss_results = calculate_nss_logic(df_input, PRECISE_MAPPING, SENTIMENT_LIB)
-        
-        if nss_results is not None and not nss_results.empty:
-            # --- 3.1 概览看板 ---
-            all_asins = ["全部"] + sorted(nss_results['ASIN'].unique().tolist())
-            selected_asin = st.selectbox("🎯 选择要深入查看的 ASIN：", all_asins)
-                     
-            if selected_asin == "全部":
-                display_df = nss_results.groupby("维度").agg({
-                    "提及句子数": "sum", "正面次数": "sum", "负面次数": "sum", "NSS分数": "mean"
-                }).reset_index()
-                plot_title = "全品类平均口碑概览 (NSS)"
-            else:
-                display_df = nss_results[nss_results['ASIN'] == selected_asin]
-                plot_title = f"ASIN: {selected_asin} 专项口碑诊断"
-
-            display_df = display_df.sort_values("NSS分数", ascending=True)
-            st.subheader(f"📊 {plot_title}")
-            
-            dynamic_height = max(500, len(display_df) * 25)
-            fig = px.bar(display_df, x="NSS分数", y="维度", orientation='h', color="NSS分数",
-                         color_continuous_scale='RdYlGn', range_color=[-1, 1], text_auto=".2f", height=dynamic_height)
-            fig.update_layout(margin=dict(l=150, r=20, t=50, b=50))
-            st.plotly_chart(fig, use_container_width=True)
-
-            # --- 3.2 数据明细表 ---
-            st.subheader("📋 维度明细数据对照表")
-            st.dataframe(display_df.style.background_gradient(subset=['NSS分数'], cmap='RdYlGn', vmin=-1, vmax=1),
-                         height=400, use_container_width=True)
-
-            # --- 3.3 月份口碑波动看板 (核心修复区) ---
-            st.subheader("📈 维度口碑月份波动看板 (2023-2025)")
-            
-            if 'Month' in df_input.columns:
-                with st.spinner('正在追溯月度趋势...'):
-                    monthly_data = calculate_nss_monthly_trend(df_input, PRECISE_MAPPING, SENTIMENT_LIB)
-                
-                if not monthly_data.empty:
-                    c1, c2 = st.columns(2)
-                    with c1:
-                        # 自动关联上方的 ASIN 选择，如果是“全部”则允许在此单独选一个看趋势
-                        trend_asin = st.selectbox("1. 趋势分析-确认 ASIN", 
-                                                  sorted(monthly_data['ASIN'].unique()), 
-                                                  index=0 if selected_asin=="全部" else sorted(monthly_data['ASIN'].unique()).index(selected_asin),
-                                                  key="trend_asin_unique")
-                    with c2:
-                        valid_dims = sorted(monthly_data[monthly_data['ASIN'] == trend_asin]['维度'].unique())
-                        chosen_dim = st.selectbox("2. 趋势分析-选择维度", valid_dims, key="trend_dim_unique")
-
-                    plot_df = monthly_data[(monthly_data['ASIN'] == trend_asin) & (monthly_data['维度'] == chosen_dim)].sort_values("月份")
-
-                    if not plot_df.empty:
-                        fig_line = px.line(plot_df, x="月份", y="NSS分数", text="NSS分数", markers=True,
-                                           title=f"【{trend_asin}】在【{chosen_dim}】维度的月度趋势",
-                                           range_y=[-1.1, 1.1], template="plotly_white")
-                        fig_line.add_hline(y=0, line_dash="dash", line_color="red")
-                        fig_line.update_traces(line_width=3, marker_size=8, textposition="top center")
-                        fig_line.update_xaxes(type='category', tickangle=45)
-                        
-                        # ✅ 确保这行代码在绘图逻辑内部，且能被正常执行
-                        st.plotly_chart(fig_line, use_container_width=True)
-                    else:
-                        st.warning("所选维度暂无月度统计数据。")
-                else:
-                    st.warning("未能根据数据生成月份趋势。")
-            else:
-                st.error("❌ 数据表中未发现 'Month' 列，无法生成时间趋势图。")
-        
-        else:
-            st.warning("未能匹配到词库中的卖点，请扩充映射表。")
+        render_progressive(render_nss_section, jobs["nss_shards"], jobs)
+        render_progressive(render_trend_section, [jobs["trend"]], jobs)
+        render_progressive(render_anomaly_section, [jobs["trend"]], jobs)
 
         # --- 4. 用户年龄画像分析 (Age Persona) ---
         st.divider()
         st.header("👥 用户年龄画像透视 (Age Demographics)")
         st.info("💡 **逻辑**：识别每条评论中的身份词。若单条评论多次提及同一标签，仅计为 1 人次，反映受众覆盖面。")
+        render_progressive(render_age_section, [jobs["age"]], jobs)
 
-        with st.spinner('正在提取年龄特征...'):
-            age_results = calculate_age_distribution(df_input, AGE_DEMOGRAPHICS_LIB)
-            
-        if not age_results.empty:
-            # ✅ 关键改动：在这里增加一个独立的下拉框，使用唯一的 key
-            age_asins = ["全部"] + sorted(age_results['ASIN'].unique().tolist())
-            # 我们给这个 selectbox 起个新名字叫 age_selected_asin，并给它唯一的 key
-            age_selected_asin = st.selectbox("🎯 选择要查看年龄画像的 ASIN：", age_asins, key="age_selector_unique")
-    
-            # 后面所有的判断都改用 age_selected_asin
-            if age_selected_asin == "全部":
-                display_age = age_results.groupby("年龄段")["提及评论数"].sum().reset_index()
-                total_hits = display_age["提及评论数"].sum()
-                display_age["占比 (%)"] = (display_age["提及评论数"] / total_hits * 100).round(1)
-                age_plot_title = "全品类受众年龄分布"
-            else:
-                display_age = age_results[age_results['ASIN'] == age_selected_asin]
-                age_plot_title = f"ASIN: {age_selected_asin} 受众年龄画像"    
-
-            if not display_age.empty:
-                # 绘图：使用漏斗图或水平条形图，清晰展示层级
-                fig_age = px.bar(
-                    display_age.sort_values("占比 (%)", ascending=True),
-                    x="占比 (%)",
-                    y="年龄段",
-                    orientation='h',
-                    text="占比 (%)",
-                    title=age_plot_title,
-                    color="年龄段",
-                    color_discrete_sequence=px.colors.qualitative.Pastel
-                )
-                
-                c1, c2 = st.columns([3, 2])
-                with c1:
-                    st.plotly_chart(fig_age, use_container_width=True)
-                with c2:
-                    st.markdown("### 🎯 核心受众判定")
-                    # 自动获取占比最高的年龄段
-                    top_age = display_age.sort_values("提及评论数", ascending=False).iloc[0]
-                    st.metric("核心受众群", top_age['年龄段'])
-                    st.write(f"在识别到身份标签的评论中，约有 **{top_age['占比 (%)']}%** 的用户指向 **{top_age['年龄段']}**。")
-                    
-                    # 商业建议小贴士
-                    if "儿童" in top_age['年龄段']:
-                        st.warning("📍 **运营建议**：建议在 Listing 中强调『无毒』、『易清洗』及『耐摔性』，视觉上增加家庭/亲子元素。")
-                    elif "成年人" in top_age['年龄段']:
-                        st.success("📍 **运营建议**：建议强调『色彩过渡』、『叠色效果』及『笔触细腻度』，视觉上走专业/艺术风格。")
-            else:
-                st.warning(f"ASIN: {age_selected_asin} 暂无明显的年龄相关特征数据。")
-        else:
-            st.warning("当前评论数据中未发现明显的年龄标签词。")
-        
         # --- 5. BS下没有标kid的前10个ASIN的儿童使用人群分析 ---
-
         st.divider()
         st.header("🧒 Top 10 ASIN 儿童使用占比分析")
         st.info("💡 **逻辑**：分析BS下没有标注'kid'的前10个ASIN，计算每个ASIN评论中儿童使用人群的占比。")
+        render_progressive(render_top10_child_section, [jobs["age"]], jobs)
 
-        # top10产品
-        top10_non_kid_asins = [
-            '',  # 请替换为实际的ASIN
-            'B07ZYFXLZ6',
-            'B07NRB5G3Q',
-            'B07VK1G863',
-            'B01GRF7NRY',
-            'B0D9B948GX',
-            'B08P4J7X8T',
-            'B0DJY2F84V',
-            'B09P7WS4P7',
-            'B08YDDCBDZ',
-            'B0D9GMMKHT'
-        ]
+        # --- 6. 词库缺口发现 ---
+        st.divider()
+        st.header("🔎 词库缺口发现 (Lexicon Gaps)")
+        st.info("💡 **逻辑**：流式统计评论中 1~4 词的高频短语，列出 EXTENDED_MAPPING 和 SENTIMENT_LIB 都没有覆盖的部分，用于补充新品牌名、新痛点。")
+        render_progressive(render_phrase_gap_section, [jobs["phrases"]], jobs)
 
-        # 简单调出数据
-        if 'age_results' in locals() and not age_results.empty:
-            # 过滤出top10 ASIN的数据
-            top10_data = age_results[age_results['ASIN'].isin(top10_non_kid_asins)]
-    
-            # 专门看儿童占比
-            child_data = top10_data[top10_data['年龄段'] == "儿童/幼儿 (0-12岁)"]
-    
-            if not child_data.empty:
-                # 简单表格展示
-                st.dataframe(child_data[["ASIN", "年龄段", "提及评论数", "占比 (%)"]]
-                             .sort_values("占比 (%)", ascending=False)
-                             .reset_index(drop=True))
-        
-                # 简单图表
-                fig = px.bar(child_data, x='ASIN', y='占比 (%)', 
-                             title='Top10 ASIN儿童使用占比',
-                             text='占比 (%)')
-                st.plotly_chart(fig, use_container_width=True)
-            else:
-                st.warning("没有找到儿童占比数据")
-        else:
-            st.warning("请先运行年龄画像分析板块")
+        # --- 7. 卖点共现与情感联动 ---
+        st.divider()
+        st.header("🔗 卖点共现分析 (Co-occurrence)")
+        st.info("💡 **逻辑**：统计同一条评论里同时提到的维度。提升度 > 1 表示两者一起出现的频率高于随机；"
+                "条件 NSS 变化表示同时提到另一维度时，该维度的口碑比整体高还是低。")
+        render_progressive(render_cooccurrence_section, [jobs["cooccurrence"]], jobs)
+
+        # --- 8. 多数据集对比 ---
+        if len(all_jobs) > 1:
+            st.divider()
+            st.header("⚖️ 多数据集对比 (Dataset Comparison)")
+            st.info("💡 **逻辑**：同一维度/年龄段/卖点在各数据集之间横向对比，Δ 列为相对基准数据集的差值。维度 NSS 为跨 ASIN 合并计数后的结果。")
+            render_progressive(render_comparison_section,
+                               [f for j in all_jobs.values() for f in [j["fuzzy"], j["age"], *j["nss_shards"]]],
+                               all_jobs)
+
+        # --- 9. 引擎一致性校验 ---
+        st.divider()
+        with st.expander("🧪 引擎一致性校验 (Reference Parity)"):
+            st.info("💡 **逻辑**：在合成数据和已上传的数据集上，分别用基准函数和待校验引擎计算，按主键逐单元格对比，超出容差的单元格和缺失/多出的行都会列出。")
+            render_parity_section(datasets, engine)
 
-            
     except Exception as e:
         st.error(f"处理文件时出错: {str(e)}")
         import traceback
@@ -1028,3 +3487,49 @@ if uploaded_file:
 
 else:
     st.info("👋 请在上方上传数据文件以开始分析。")
+
+def main(argv=None):
+    """命令行入口：serve 启动本地 API；partition 计算分区部分结果；merge 合并分区并写出报告。"""
+    import argparse
+    parser = argparse.ArgumentParser(description="酒精笔评论分析命令行")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="在本机启动分析 API（默认）")
+    partition = commands.add_parser("partition", help="按 ASIN 哈希分区计算部分结果，已完成的分区自动跳过")
+    partition.add_argument("inputs", nargs="+", help="输入文件（.csv / .xlsx / .parquet）")
+    partition.add_argument("--parts", type=int, required=True, help="分区总数")
+    partition.add_argument("--index", default="all", help="本次计算的分区序号，逗号分隔，或 all")
+    partition.add_argument("--out", required=True, help="部分结果文件输出目录")
+    partition.add_argument("--splitter", choices=list(SENTENCE_SPLITTERS), help="分句后端，默认随默认引擎")
+    merge = commands.add_parser("merge", help="合并全部分区文件")
+    merge.add_argument("partials", nargs="+", help="部分结果文件")
+    merge.add_argument("--out", required=True, help="报告路径：.xlsx 或 .zip (Parquet)")
+    args = parser.parse_args(argv)
+
+    if args.command == "partition":
+        if args.splitter == "punkt" and not PUNKT_AVAILABLE:
+            parser.error("未找到 NLTK punkt 数据包，请改用 --splitter regex")
+        indexes = range(args.parts) if args.index == "all" else [int(i) for i in args.index.split(",")]
+        for index in indexes:
+            path, computed = run_partition(args.inputs, args.parts, index, args.out, args.splitter)
+            print(f"[{index}/{args.parts}] {'完成' if computed else '已存在，跳过'}：{path}")
+    elif args.command == "merge":
+        writer = {".xlsx": write_excel_report, ".zip": write_parquet_bundle}.get(os.path.splitext(args.out)[1])
+        if writer is None:
+            parser.error("--out 需以 .xlsx 或 .zip 结尾")
+        try:
+            tables = merge_partials(args.partials)
+        except ValueError as e:
+            parser.error(str(e))
+        writer(tables, args.out)
+        print(f"已合并 {len(args.partials)} 个分区：{args.out}")
+    else:
+        api_service = start_analysis_service(API_PORT)
+        print(f"分析 API 已启动：http://127.0.0.1:{API_PORT}（Ctrl+C 退出）")
+        try:
+            api_service.thread.join()
+        except KeyboardInterrupt:
+            api_service.server.shutdown()
+
+# 直接用 python 运行（不经 streamlit run）时不渲染看板，走命令行入口，便于离线联调和多机分区计算
+if __name__ == "__main__" and not st.runtime.exists():
+    main()